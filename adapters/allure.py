@@ -2,26 +2,129 @@ import os
 import json
 import base64
 import logging
-from time import sleep
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Iterable, Iterator
+from time import monotonic
 from dotenv import load_dotenv
 from tools.dates import form_timedelta, change_date_pattern, change_to_timestamp
 from tools.http_client import http_client
+from tools.projects import form_project_ids
+from adapters.results import LaunchResultsAggregator
+from tools.deadline import Deadline
+from exceptions import DeadlineExceeded, HttpResponseErrors
 
 load_dotenv()
 
 
-class AllureAdapter:
+class AllureSession:
     """
-    Allure TestOps API adapter
+    Authorized Allure TestOps client shared by the projects
     """
 
     def __init__(self):
         self._allure_url = os.environ.get('ALLURE_URL')
-        self._allure_project = os.environ.get('ALLURE_PROJECT')
         self._allure_token = os.environ.get('ALLURE_USER_TOKEN')
-        self._timedelta = os.environ.get('REPORT_TIMEDELTA')
+        self._token_margin = int(os.environ.get('ALLURE_TOKEN_REFRESH_MARGIN', 60))
         self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
         self._headers = None
+        self._client = http_client(
+            base_url=self._allure_url,
+            pool_size=int(os.environ.get('HTTP_POOL_SIZE', 10)),
+            keep_alive=os.environ.get('HTTP_KEEP_ALIVE', 'True') == 'True',
+            connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)),
+            read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', 30)),
+            gzip=os.environ.get('HTTP_GZIP', 'True') == 'True'
+        )
+        self._in_flight = threading.BoundedSemaphore(int(os.environ.get('ALLURE_MAX_IN_FLIGHT', 10)))
+
+    def connection_stats(self) -> dict:
+        """
+        Get connection statistic
+        :return: return the number of opened and reused connections to Allure TestOps
+        """
+        return self._client.connection_stats()
+
+    # Authorization methods
+
+    def login_with_token(self) -> None:
+        """Login in allure with token"""
+        response_token = self._client.post(
+            endpoint='/api/uaa/oauth/token',
+            data={
+                'token': self._allure_token,
+                'grant_type': 'apitoken',
+                'scope': 'openid'
+            }
+        )
+        token = response_token.json()
+        expires_in = token.get('expires_in')
+        self._token = token['access_token']
+        self._headers = {'Authorization': 'Bearer ' + self._token}
+        if expires_in:
+            self._token_expires_at = monotonic() + int(expires_in) - self._token_margin
+        else:
+            self._token_expires_at = float('inf')
+        logging.debug(f"Allure token refreshed, expires in {expires_in} seconds")
+
+    def _token_valid(self) -> bool:
+        return self._headers is not None and monotonic() < self._token_expires_at
+
+    def authorize(self, rejected_headers: dict = None) -> None:
+        """
+        Refresh the cached token when it is missing, expiring or rejected.
+        Concurrent callers wait for a single refresh request
+        :param rejected_headers: headers rejected by Allure TestOps with 401
+        """
+        if rejected_headers is None and self._token_valid():
+            return
+        with self._token_lock:
+            if rejected_headers is None and self._token_valid():
+                return
+            if rejected_headers is not None and self._headers is not rejected_headers:
+                return
+            self.login_with_token()
+
+    def get(self, endpoint: str, budget: threading.BoundedSemaphore, **kwargs):
+        """
+        Authorized GET request, the request is replayed once with a new token on 401
+        :param endpoint: endpoint
+        :param budget: in-flight requests limit of the project
+        :return: return the response
+        """
+        self.authorize()
+        headers = self._headers
+        with budget, self._in_flight:
+            try:
+                return self._client.get(endpoint=endpoint, headers=headers, **kwargs)
+            except HttpResponseErrors as error:
+                if error.status_code != 401:
+                    raise
+            logging.info(f"Allure token rejected on '{endpoint}', refreshing")
+        self.authorize(rejected_headers=headers)
+        with budget, self._in_flight:
+            return self._client.get(endpoint=endpoint, headers=self._headers, **kwargs)
+
+
+class AllureAdapter:
+    """
+    Allure TestOps API adapter of one project.
+    Each project fetches its launches with its own workers and in-flight requests limit
+    """
+
+    def __init__(self, session: AllureSession, project_id: str):
+        self._session = session
+        self._allure_project = project_id
+        self._timedelta = os.environ.get('REPORT_TIMEDELTA')
+        self._page_size = int(os.environ.get('ALLURE_PAGE_SIZE', 100))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('ALLURE_FETCH_WORKERS', 8)),
+            thread_name_prefix=f'allure-{project_id}'
+        )
+        self._in_flight = threading.BoundedSemaphore(int(os.environ.get('ALLURE_PROJECT_MAX_IN_FLIGHT', 4)))
 
     @staticmethod
     def _encode_request(request: dict) -> str:
@@ -52,147 +155,205 @@ class AllureAdapter:
             "value": time_value
         }
 
-    # Authorization methods
+    @property
+    def project(self) -> str:
+        return self._allure_project
 
-    def login_with_token(self) -> None:
-        """Login in allure with token"""
-        response_token = http_client(base_url=self._allure_url).post(
-            endpoint='/api/uaa/oauth/token',
-            data={
-                'token': self._allure_token,
-                'grant_type': 'apitoken',
-                'scope': 'openid'
-            }
-        )
-        self._token = response_token.json()['access_token']
-        self._headers = {'Authorization': 'Bearer ' + self._token}
+    def connection_stats(self) -> dict:
+        return self._session.connection_stats()
+
+    def authorize(self) -> None:
+        self._session.authorize()
+
+    def _get(self, endpoint: str, **kwargs):
+        return self._session.get(endpoint, self._in_flight, **kwargs)
+
+    def _fan_out(self, allure_launches: dict, fetchers: dict, deadline: Deadline = None) -> tuple:
+        """
+        Fetch launch data concurrently for all finished launches
+        :param allure_launches: allure launches
+        :param fetchers: fetch functions by data type, each one takes a launch id
+        :param deadline: deadline of the stage, unlimited by default
+        :return: return the fetched data by data type and launch id, the launches not fetched in time
+                 and the launches failed to be fetched
+        """
+        deadline = deadline or Deadline(None)
+        futures = dict()
+        for key, value in allure_launches.items():
+            if value['status'] == "finished":
+                for data_type, fetch in fetchers.items():
+                    futures[(data_type, key)] = self._executor.submit(fetch, key)
+        _, not_done = deadline.wait(futures.values())
+
+        fetched = {data_type: dict() for data_type in fetchers}
+        late, failed = set(), set()
+        for (data_type, key), future in futures.items():
+            if future in not_done:
+                late.add(key)
+                continue
+            try:
+                fetched[data_type][key] = future.result()
+            except DeadlineExceeded:
+                late.add(key)
+            except Exception as error:
+                logging.error(f"Launch '{key}' {data_type} has not been fetched: {error}")
+                failed.add(key)
+        late -= failed
+        for data_type in fetched:
+            for key in late | failed:
+                fetched[data_type].pop(key, None)
+        if late:
+            logging.warning(f"Launches {sorted(late)} have not been fetched in time, deferred")
+        return fetched, late, failed
+
+    def _iter_pages(self, endpoint: str, params: dict, prefetch: bool = False,
+                    deadline: Deadline = None) -> Iterator[dict]:
+        """
+        Iterate over the content of a paged endpoint until 'totalPages' is reached.
+        The iteration stops early at the deadline, which is marked as exceeded then
+        :param endpoint: endpoint
+        :param params: request params without page and size
+        :param prefetch: request the next page while the current one is processed
+        :param deadline: deadline of the stage, unlimited by default
+        :return: return the items page by page
+        """
+        deadline = deadline or Deadline(None)
+
+        def fetch(page_number: int) -> dict:
+            response = self._get(endpoint=endpoint, params={**params, 'page': page_number, 'size': self._page_size})
+            return json.loads(response.text)
+
+        page_number = 0
+        page = fetch(page_number)
+        while True:
+            page_number += 1
+            has_next = page_number < page.get('totalPages', 0)
+            next_page = self._executor.submit(fetch, page_number) if has_next and prefetch else None
+            yield from page['content']
+            if not has_next:
+                break
+            if deadline.expired():
+                if next_page:
+                    next_page.cancel()
+                logging.warning(f"'{endpoint}' stopped at page {page_number} of {page['totalPages']} by the deadline")
+                break
+            try:
+                page = deadline.result(next_page) if next_page else fetch(page_number)
+            except DeadlineExceeded:
+                logging.warning(f"'{endpoint}' stopped at page {page_number} of {page['totalPages']} by the deadline")
+                break
 
     # Launch data methods
 
-    def get_last_launches(self) -> list:
+    def iter_last_launches(self, created_after: float = None, deadline: Deadline = None) -> Iterator[dict]:
         """
-        Get last launches
-        :return: return the list of last launches
+        Iterate over last launches, page by page
+        :param created_after: timestamp in milliseconds, limited by the 'REPORT_TIMEDELTA' window
+        :param deadline: deadline of the discovery, the launches found before it are returned
+        :return: return the last launches as soon as their page is received
         """
         launch_query = self._form_search_query(request_id='createdAfter', request_type='long')
+        if created_after and created_after > launch_query['value']:
+            launch_query['value'] = created_after
         search_list = self._encode_request(launch_query)
-        last_launches = http_client(base_url=self._allure_url).get(
-            headers=self._headers,
+        return self._iter_pages(
             endpoint='/api/rs/launch',
             params={
                 'projectId': self._allure_project,
-                'page': 0,
                 'preview': 'true',
-                'search': search_list,
-                'size': 100
-            }
+                'search': search_list
+            },
+            prefetch=True,
+            deadline=deadline
         )
-        return json.loads(last_launches.text)['content']
 
-    def get_launch_defects(self, allure_launches: dict) -> dict:
+    def get_launch(self, launch_id: int) -> dict:
         """
-        Get launch defects
-        :param allure_launches: allure launches
-        :return: return launch dict with defect
+        Get launch
+        :param launch_id: launch id
+        :return: return the launch info
         """
-        launch_results = dict()
-        for key, value in allure_launches.items():
-            if value['status'] == "finished":
-                defects_job_info = http_client(base_url=self._allure_url).get(
-                    headers=self._headers,
-                    endpoint=f'/api/rs/launch/{key}/defect'
-                )
-                if json.loads(defects_job_info.text)['content']:
-                    defects = json.loads(defects_job_info.text)['content']
-                    for defect in defects:
-                        defect.pop('closed')
-                        defect.pop('count')
-                    launch_results[key] = {'defects': defects}
-        return launch_results
-
-    def get_launch_statistic(self, allure_launches: dict) -> dict:
+        launch_info = self._get(
+            endpoint=f'/api/rs/launch/{launch_id}'
+        )
+        return json.loads(launch_info.text)
+
+    def _fetch_launch_defects(self, launch_id: int) -> list:
+        defects_job_info = self._get(
+            endpoint=f'/api/rs/launch/{launch_id}/defect'
+        )
+        defects = json.loads(defects_job_info.text)['content']
+        for defect in defects:
+            defect.pop('closed')
+            defect.pop('count')
+        return defects
+
+    def _fetch_launch_statistic(self, launch_id: int) -> list:
+        result = self._get(
+            endpoint=f'/api/rs/launch/{launch_id}/statistic',
+        )
+        return json.loads(result.text)
+
+    def _fetch_launch_results(self, launch_id: int, deadline: Deadline = None) -> list:
+        deadline = deadline or Deadline(None)
+        leaves = self._iter_pages(
+            endpoint='/api/rs/testresulttree/leaf',
+            params={
+                'launchId': launch_id
+            },
+            deadline=deadline
+        )
+        aggregator = LaunchResultsAggregator().consume(leaves)
+        if deadline.exceeded:
+            raise DeadlineExceeded(deadline.stage)
+        logging.debug(f"Launch '{launch_id}' results: {dict(aggregator.counts)}")
+        return aggregator.results
+
+    @staticmethod
+    def _form_defects(defects: dict) -> dict:
+        return {key: {'defects': value} for key, value in defects.items() if value}
+
+    @staticmethod
+    def _form_statistic(statistic: dict) -> dict:
+        return {key: {'statistic': value} for key, value in statistic.items()}
+
+    def fetch_launch_details(self, allure_launches: dict, deadline: Deadline = None) -> tuple:
         """
-        Get launch statistic
+        Fetch results, statistic and defects of all finished launches in parallel
         :param allure_launches: allure launches
-        :return: return statistic dict
+        :param deadline: deadline of the stage, unlimited by default
+        :return: return launch results, statistic and defects dicts, the launches not fetched in time
+                 and the launches failed to be fetched
         """
-        statistic = dict()
-        for key, value in allure_launches.items():
-            if value['status'] == "finished":
-                result = http_client(base_url=self._allure_url).get(
-                    headers=self._headers,
-                    endpoint=f'/api/rs/launch/{key}/statistic',
-                )
-                launch = json.loads(result.text)
-                statistic[key] = {'statistic': launch}
-        return statistic
+        fetched, late, failed = self._fan_out(allure_launches, {
+            'results': partial(self._fetch_launch_results, deadline=deadline),
+            'statistic': self._fetch_launch_statistic,
+            'defects': self._fetch_launch_defects
+        }, deadline)
+        return fetched['results'], self._form_statistic(fetched['statistic']), \
+            self._form_defects(fetched['defects']), late, failed
 
     # Parse launch data methods
 
     @staticmethod
-    def parse_launches_with_id(data: list) -> tuple:
+    def parse_launches_with_id(data: Iterable) -> tuple:
         """
         Parse launches with id
-        :param data: launches list
+        :param data: launches list or iterator
         :return: return launches and id launch
         """
         launches = dict()
+        id_launch = set()
         for item in data:
             launches[item.get("id")] = dict()
             launches[item.get("id")]['status'] = item.get("id")
             launches[item.get("id")]['name'] = item.get("name")
-        id_launch = list({int(item["id"]) for item in data})
-        return launches, id_launch
-
-    @staticmethod
-    def parse_launch_results(launch_results: dict) -> dict:
-        """
-        Parse launch results
-        :param launch_results: launch dict
-        :return: return the dictionary with basic data
-        """
-        results_modify = dict()
-        for key, value in launch_results.items():
-            test_case_results = []
-            for item in value:
-                test_case = dict()
-                test_case["test_case_id"] = item.get("testCaseId")
-                test_case["test_case_launch_id"] = item.get("id")
-                test_case["name"] = item.get("name")
-                test_case["status"] = item.get("status")
-                test_case_results.append(test_case)
-            results_modify[key] = test_case_results
-        return results_modify
+            launches[item.get("id")]['created_date'] = item.get("createdDate")
+            id_launch.add(int(item["id"]))
+        return launches, list(id_launch)
 
     # Launch analysis methods
 
-    def analyze_results(self, allure_launches: dict) -> dict:
-        """
-        Analyze launch results
-        :param allure_launches: launches dict
-        :return: return the sorted dictionary with runs in 'finish' status
-        """
-        launch_results = dict()
-        for key, value in allure_launches.items():
-            if value['status'] == "finished":
-                job_info = http_client(base_url=self._allure_url).get(
-                    headers=self._headers,
-                    endpoint='/api/rs/testresulttree/leaf',
-                    params={
-                        'launchId': key,
-                        'size': 100
-                    }
-                )
-                launch_result = json.loads(job_info.text)['content']
-                launch_results[key] = launch_result
-        return launch_results
-
-    @staticmethod
-    def compare_results(launches: dict, pipeline_statuses: dict) -> dict:
-        for key, value in launches.items():
-            launches[key]['status'] = pipeline_statuses[value['status']]
-        return launches
-
     @staticmethod
     def compare_processed_launches(launch_summary: dict, processed_launches: list) -> dict:
         for item in processed_launches:
@@ -218,7 +379,8 @@ class AllureAdapter:
         for key, value in launch_results.items():
             summary[key]['summary'] = value
         for key, value in compared_launches.items():
-            summary[key]['name'] = compared_launches[key]['name']
+            if key in summary:
+                summary[key]['name'] = compared_launches[key]['name']
         for key, value in statistic.items():
             summary[key]['statistic'] = statistic[key]['statistic']
         for key, value in defects.items():
@@ -233,33 +395,45 @@ class AllureAdapter:
         :param launch_id: launch id
         :return: launch status
         """
-        launch_info = http_client(base_url=self._allure_url).get(
-            headers=self._headers,
+        launch_info = self._get(
             endpoint=f'/api/rs/launch/{launch_id}/job'
         )
-        return json.loads(launch_info.text)[0].get('stage')
+        jobs = json.loads(launch_info.text)
+        return jobs[0].get('stage') if jobs else None
 
-    def wait_launch_status(self, launch_id: list, retries: int = 50, interval: int = 10) -> dict:
+    def get_launch_statuses(self, launch_id: list, deadline: Deadline = None) -> tuple:
         """
-        Wait launch status
+        Get launch statuses in one concurrent batch.
+        A launch whose status has not been received is returned with None stage, so it is checked again
         :param launch_id: id launch list
-        :param retries: number of reruns
-        :param interval: number of interval
-        :return: return launch status dict
+        :param deadline: deadline of the stage, unlimited by default
+        :return: return launch status dict, without the launches not checked in time,
+                 and the launches deleted in Allure TestOps
         """
-        statuses = dict()
-        for launch in launch_id:
-            while retries > 0:
-                launch_status = self.get_launch_status(launch)
-                if launch_status in ["finished", "run_failure"]:
-                    statuses.update({launch: launch_status})
-                    break
-                else:
-                    logging.debug(f"Waiting for launch '{self._allure_url}/launch/{launch}' finished status")
-                    sleep(interval)
-                    retries -= 1
+        deadline = deadline or Deadline(None)
+        futures = {launch: self._executor.submit(self.get_launch_status, launch) for launch in launch_id}
+        _, not_done = deadline.wait(futures.values())
+        if not_done:
+            logging.warning(f"{len(not_done)} launch statuses have not been checked in time, deferred")
+
+        statuses, deleted = dict(), list()
+        for launch, future in futures.items():
+            if future in not_done:
+                continue
+            try:
+                statuses[launch] = future.result()
+            except HttpResponseErrors as error:
+                if error.status_code == 404:
+                    logging.info(f"Launch '{launch}' has been deleted")
+                    deleted.append(launch)
                     continue
-        return statuses
+                logging.error(f"Status of launch '{launch}' has not been received: {error}")
+                statuses[launch] = None
+            except Exception as error:
+                logging.error(f"Status of launch '{launch}' has not been received: {error}")
+                statuses[launch] = None
+        return statuses, deleted
 
 
-allure = AllureAdapter()
+allure_session = AllureSession()
+allure_projects = {project_id: AllureAdapter(allure_session, project_id) for project_id in form_project_ids()}
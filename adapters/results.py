@@ -0,0 +1,40 @@
+from collections import Counter
+from typing import Iterable
+
+
+class LaunchResultsAggregator:
+    """
+    Streaming aggregator of launch test results.
+    Keeps the number of tests by status and only the test results needed for the report
+    """
+
+    report_statuses = ("failed", "broken")
+
+    def __init__(self):
+        self.counts = Counter()
+        self.results = list()
+
+    @staticmethod
+    def parse_test_case(item: dict) -> dict:
+        """
+        Parse test case
+        :param item: test result leaf
+        :return: return the dictionary with basic data
+        """
+        return {
+            "test_case_id": item.get("testCaseId"),
+            "test_case_launch_id": item.get("id"),
+            "name": item.get("name"),
+            "status": item.get("status")
+        }
+
+    def add(self, item: dict) -> None:
+        status = item.get("status")
+        self.counts[status] += 1
+        if status in self.report_statuses:
+            self.results.append(self.parse_test_case(item))
+
+    def consume(self, items: Iterable) -> 'LaunchResultsAggregator':
+        for item in items:
+            self.add(item)
+        return self
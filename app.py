@@ -0,0 +1,114 @@
+import os
+import signal
+import logging
+import threading
+from handlers.utils import flush_persistence
+from handlers.subscriptions import subscriptions
+from handlers.leases import leases
+from handlers.commands import start, help_info, remove_notify, poll_project, notify_critical, notify_all, \
+    set_projects, push_launch
+from handlers.scheduler import scheduler
+from handlers.webhook import LaunchWebhook
+
+from functools import partial
+from tools.projects import form_project_ids
+from persistence.mongo import mongo_persistence
+from telegram import Update
+from telegram.ext import Updater, CommandHandler
+
+
+def take_commands(updater: Updater) -> None:
+    """
+    Start handling the bot commands with the chat data written by the previous leading replica
+    :param updater: updater
+    """
+    dispatcher = updater.dispatcher
+    for data, stored in ((dispatcher.chat_data, mongo_persistence.get_chat_data()),
+                         (dispatcher.user_data, mongo_persistence.get_user_data()),
+                         (dispatcher.bot_data, mongo_persistence.get_bot_data())):
+        data.clear()
+        data.update(stored)
+    subscriptions.rebuild()
+    mongo_persistence.read_only = False
+    updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+
+def drop_commands(updater: Updater) -> None:
+    """
+    Stop handling the bot commands and writing the chat data until the replica is elected again
+    :param updater: updater
+    """
+    mongo_persistence.read_only = True
+    if updater.running:
+        # only the polling and the dispatcher threads are stopped, the job queue keeps running
+        updater.running = False
+        updater._stop_dispatcher()
+        updater._join_threads()
+        logging.info("Bot commands are not handled until the replica is elected again")
+
+
+def wait_for_stop() -> None:
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(signum, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+
+def main() -> None:
+    mongo_persistence.create_indexes()
+    mongo_persistence.adopt_launches(form_project_ids()[0])
+    subscriptions.rebuild()
+
+    # the chat data is written only by the replica handling the commands
+    mongo_persistence.read_only = True
+    updater = Updater(
+        token=os.environ.get('BOT_TOKEN'),
+        persistence=mongo_persistence
+    )
+
+    dispatcher = updater.dispatcher
+    dispatcher.add_handler(CommandHandler(command="start", callback=start))
+    dispatcher.add_handler(CommandHandler(command="help_info", callback=help_info))
+    dispatcher.add_handler(CommandHandler(command="notify_all", callback=notify_all))
+    dispatcher.add_handler(CommandHandler(command="notify_critical", callback=notify_critical))
+    dispatcher.add_handler(CommandHandler(command="remove_notify", callback=remove_notify))
+    dispatcher.add_handler(CommandHandler(command="set_projects", callback=set_projects))
+
+    leases.elect(on_elected=partial(take_commands, updater), on_deposed=partial(drop_commands, updater))
+    dispatcher.job_queue.run_repeating(
+        callback=leases.heartbeat,
+        interval=int(os.environ.get("LEASE_HEARTBEAT_INTERVAL", 10)),
+        first=0
+    )
+    scheduler.start(
+        job_queue=dispatcher.job_queue,
+        poll=poll_project,
+        projects=form_project_ids(),
+        first=10
+    )
+    dispatcher.job_queue.run_repeating(
+        callback=flush_persistence,
+        interval=int(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", 60))
+    )
+
+    webhook = None
+    if os.environ.get("WEBHOOK_ENABLED") == 'True':
+        webhook = LaunchWebhook(
+            host=os.environ.get("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.environ.get("WEBHOOK_PORT", 8080)),
+            secret=os.environ.get("WEBHOOK_SECRET"),
+            enqueue=partial(push_launch, dispatcher.job_queue)
+        )
+        webhook.start()
+
+    dispatcher.job_queue.start()
+    wait_for_stop()
+    if updater.running:
+        dispatcher.update_persistence()
+        mongo_persistence.flush()
+    updater.stop()
+    if webhook:
+        webhook.stop()
+    leases.release()
+
@@ -0,0 +1,69 @@
+import json
+import resource
+import subprocess
+import sys
+from os import path
+from time import perf_counter
+from click import command, echo, option, INT
+
+ROOT = path.abspath(path.join(path.dirname(__file__), '..'))
+RENDERERS = ['matplotlib', 'native']
+
+
+def measure(renderer: str, rounds: int) -> dict:
+    """
+    Measure chart rendering in the current process
+    :param renderer: renderer name
+    :param rounds: number of renders
+    :return: return the import time, render time, peak memory and image size
+    """
+    sys.path.insert(0, ROOT)
+    start = perf_counter()
+    from reporters.renderers import renderer_class
+    chart_renderer = renderer_class(renderer)()
+    import_time = perf_counter() - start
+
+    start = perf_counter()
+    chart = chart_renderer.render(1240, 37, 113)
+    first_render = perf_counter() - start
+
+    start = perf_counter()
+    for index in range(rounds):
+        chart_renderer.render(1240 + index, 37, 113)
+    render_time = (perf_counter() - start) / rounds
+
+    return {
+        'renderer': renderer,
+        'import_ms': import_time * 1000,
+        'first_render_ms': first_render * 1000,
+        'render_ms': render_time * 1000,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'size_kb': len(chart) / 1024
+    }
+
+
+@command()
+@option("--rounds", default=10, type=INT, help='Number of renders per renderer, default \'10\'')
+def benchmark(rounds):
+    """
+    Compares render time and memory of the chart renderers, each one in a fresh process
+    """
+    results = list()
+    for renderer in RENDERERS:
+        output = subprocess.run(
+            [sys.executable, __file__, '--measure', renderer, str(rounds)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output))
+
+    echo(f"{'renderer':<12}{'import, ms':>12}{'first, ms':>12}{'render, ms':>12}{'max RSS, MB':>14}{'PNG, KB':>10}")
+    for result in results:
+        echo(f"{result['renderer']:<12}{result['import_ms']:>12.1f}{result['first_render_ms']:>12.1f}"
+             f"{result['render_ms']:>12.1f}{result['max_rss_mb']:>14.1f}{result['size_kb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure':
+        print(json.dumps(measure(sys.argv[2], int(sys.argv[3]))))
+    else:
+        benchmark()
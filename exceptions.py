@@ -9,3 +9,15 @@ class HttpResponseErrors(Exception):
 
     def __str__(self):
         return f"Expected status code [{self.expected_code}] not equals [{self.status_code}]"
+
+
+class DeadlineExceeded(Exception):
+    """
+    Time budget of the stage is over
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        super().__init__()
+
+    def __str__(self):
+        return f"Time budget of the '{self.stage}' stage is over"
@@ -0,0 +1,147 @@
+import os
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import count
+from queue import Empty, PriorityQueue
+from time import monotonic, sleep
+from typing import Callable
+from telegram.error import RetryAfter, Unauthorized
+from tools.deadline import Deadline
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self._rate = rate
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait for a token"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self._rate
+            sleep(delay)
+
+
+class Broadcaster:
+    """
+    Rate limited concurrent message delivery
+    """
+
+    def __init__(self, workers: int = 8, rate: float = 30, chat_rate: float = 1, retries: int = 3):
+        self._workers = workers
+        self._bucket = TokenBucket(rate)
+        self._chat_interval = 1 / chat_rate
+        self._retries = retries
+        self._chat_slots = dict()
+        self._chat_lock = threading.Lock()
+        self._sequence = count()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+
+    def _wait_chat(self, chat_id) -> None:
+        """Wait for the next free slot of the chat"""
+        with self._chat_lock:
+            now = monotonic()
+            slot = max(now, self._chat_slots.get(chat_id, 0) + self._chat_interval)
+            self._chat_slots[chat_id] = slot
+        if slot > now:
+            sleep(slot - now)
+
+    def _deliver(self, chat_id, deliver: Callable, on_unauthorized: Callable) -> str:
+        """
+        Deliver a message to one chat
+        :return: return the delivery outcome
+        """
+        self._wait_chat(chat_id)
+        self._bucket.acquire()
+        try:
+            deliver(chat_id)
+            return 'delivered'
+        except Unauthorized as error:
+            logging.info(error.message)
+            on_unauthorized(chat_id)
+            return 'unauthorized'
+        except RetryAfter:
+            raise
+        except Exception as error:
+            logging.error(f"Message to '{chat_id}' has not been delivered: {error}")
+            return 'failed'
+
+    def broadcast(self, chat_ids: list, deliver: Callable, on_unauthorized: Callable,
+                  deadline: Deadline = None) -> Counter:
+        """
+        Deliver a message to all chats, requeueing the chats limited by Telegram flood control
+        :param chat_ids: chat ids
+        :param deliver: function sending the message to a chat id
+        :param on_unauthorized: function called for chats which have blocked the bot
+        :param deadline: deadline of the delivery, the chats not reached before it are dropped
+        :return: return the number of deliveries by outcome
+        """
+        deadline = deadline or Deadline(None)
+        deliveries = PriorityQueue()
+        for chat_id in chat_ids:
+            deliveries.put((0, next(self._sequence), chat_id, 0))
+        outcomes = Counter()
+        remaining = [len(chat_ids)]
+        lock = threading.Lock()
+
+        def work() -> None:
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                try:
+                    not_before, _, chat_id, attempt = deliveries.get(timeout=0.1)
+                except Empty:
+                    continue
+                if not_before > monotonic():
+                    sleep(not_before - monotonic())
+
+                started = monotonic()
+                try:
+                    outcome = 'dropped' if deadline.expired() else self._deliver(chat_id, deliver, on_unauthorized)
+                except RetryAfter as error:
+                    budget = deadline.remaining()
+                    if budget is not None and error.retry_after >= budget:
+                        outcome = 'dropped'
+                    elif attempt < self._retries:
+                        logging.info(f"Flood control for '{chat_id}', retry in {error.retry_after} seconds")
+                        deliveries.put((monotonic() + error.retry_after, next(self._sequence), chat_id, attempt + 1))
+                        with lock:
+                            outcomes['retried'] += 1
+                        continue
+                    else:
+                        outcome = 'failed'
+                logging.debug(f"Delivery to '{chat_id}': {outcome} in {monotonic() - started:.2f}s, "
+                              f"attempt {attempt + 1}")
+                with lock:
+                    outcomes[outcome] += 1
+                    remaining[0] -= 1
+
+        wait([self._executor.submit(work) for _ in range(min(self._workers, len(chat_ids)))])
+        logging.info(f"Broadcast to {len(chat_ids)} chats: {dict(outcomes)}")
+        if outcomes['dropped']:
+            logging.warning(f"Deliveries to {outcomes['dropped']} chats dropped by the '{deadline.stage}' deadline")
+        return outcomes
+
+
+broadcaster = Broadcaster(
+    workers=int(os.environ.get('BROADCAST_WORKERS', 8)),
+    rate=float(os.environ.get('BROADCAST_RATE', 30)),
+    chat_rate=float(os.environ.get('BROADCAST_CHAT_RATE', 1)),
+    retries=int(os.environ.get('BROADCAST_RETRIES', 3))
+)
@@ -1,13 +1,32 @@
 import os
 import logging
+import threading
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Optional
 from telegram import Update, parsemode
-from telegram.error import Unauthorized
-from telegram.ext import CallbackContext
-from handlers.utils import collect_launch_statistic, unsubscribe, subscribe_all, set_chat_info, subscribe_critical
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext, JobQueue
+from adapters.allure import AllureAdapter, allure_projects
+from handlers.utils import collect_launch_statistic, unsubscribe, subscribe_all, set_chat_info, subscribe_critical, \
+    get_report_file_id, set_report_file_id, remove_report_file_id, set_chat_projects, enqueue_launch
+from handlers.broadcast import broadcaster
+from handlers.leases import leases
+from handlers.scheduler import scheduler
+from handlers.subscriptions import subscriptions
 from reporters.chart import reporter
+from tools.deadline import Deadline, stage_deadline
+from tools.projects import form_project_ids
+from exceptions import HttpResponseErrors
 
 report_critical = os.environ.get('REPORT_CRITICAL_PERCENT')
 
+_pipelines = ThreadPoolExecutor(max_workers=max(len(allure_projects), 1), thread_name_prefix='project')
+_running = dict()
+_rerun = set()
+_running_lock = threading.Lock()
+
 
 def start(update: Update, context: CallbackContext) -> None:
     from_user = update.message.from_user.name
@@ -18,7 +37,8 @@ def start(update: Update, context: CallbackContext) -> None:
 
 def help_info(update: Update, context: CallbackContext) -> None:
     message = "Send /notify_all to activate notifications to all notification \n" \
-              "Send /notify_critical to activate notifications for critical notifications\n" \
+              "Send /notify_critical [percent] to activate notifications for critical notifications\n" \
+              "Send /set_projects [project ...] to choose projects of notifications, all projects by default\n" \
               "Send /remove_notify to deactivate all notifications\n"
     update.message.reply_text(message)
 
@@ -52,9 +72,10 @@ def notify_all(update: Update, context: CallbackContext) -> None:
         set_chat_info(update, context, chat_id)
         text = 'You have subscribed for all notifications!'
     elif subscription == 'critical':
+        critical_percent = _critical_percent(context.dispatcher.chat_data[chat_id])
         subscribe_all(context, chat_id)
         set_chat_info(update, context, chat_id)
-        text = f'Done! You have changed subscriptions from critical > {report_critical}% to all!'
+        text = f'Done! You have changed subscriptions from critical > {critical_percent}% to all!'
     elif subscription == 'all':
         text = 'Oops! You have already subscribed for all notifications!'
     else:
@@ -64,80 +85,259 @@ def notify_all(update: Update, context: CallbackContext) -> None:
 
 def notify_critical(update: Update, context: CallbackContext) -> None:
     """
-    Subscribe to critical launch notification
+    Subscribe to critical launch notification, the critical percent of the chat can be passed as an argument
     """
     chat_id = update.message.chat_id
-    subscription = context.dispatcher.chat_data[chat_id].get("subscription")
+    chat_data = context.dispatcher.chat_data[chat_id]
+    subscription = chat_data.get("subscription")
+
+    critical_percent = None
+    if context.args:
+        try:
+            critical_percent = int(context.args[0])
+        except ValueError:
+            critical_percent = -1
+        if not 0 <= critical_percent <= 100:
+            update.message.reply_text('Critical percent must be a number from 0 to 100')
+            return
+    percent = report_critical if critical_percent is None else critical_percent
 
     if not subscription:
-        subscribe_critical(context, chat_id)
+        subscribe_critical(context, chat_id, critical_percent)
         set_chat_info(update, context, chat_id)
-        text = f'You have subscribed to \'critical\' with > {report_critical}%'
+        text = f'You have subscribed to \'critical\' with > {percent}%'
     elif subscription == 'all':
-        subscribe_critical(context, chat_id)
+        subscribe_critical(context, chat_id, critical_percent)
         set_chat_info(update, context, chat_id)
-        text = f'Subscription changed to \'critical\' with > {report_critical}%'
+        text = f'Subscription changed to \'critical\' with > {percent}%'
+    elif subscription == 'critical' and chat_data.get("critical_percent") != critical_percent:
+        subscribe_critical(context, chat_id, critical_percent)
+        text = f'Critical percent changed to > {percent}%'
     elif subscription == 'critical':
-        text = f'You have already subscribed to \'critical\' with > {report_critical}%'
+        text = f'You have already subscribed to \'critical\' with > {percent}%'
     else:
         text = 'Command execution error'
     update.message.reply_text(text)
 
 
-def perform_notify(context: CallbackContext) -> None:
+def _critical_percent(chat_data: dict) -> int:
+    critical_percent = chat_data.get("critical_percent")
+    return int(report_critical) if critical_percent is None else critical_percent
+
+
+def set_projects(update: Update, context: CallbackContext) -> None:
+    """
+    Choose projects of notifications, all projects without arguments
+    """
+    chat_id = update.message.chat_id
+    projects = [project for argument in context.args for project in form_project_ids(argument)]
+    unknown = [project for project in projects if project not in allure_projects]
+
+    if unknown:
+        text = f"Unknown projects: {', '.join(unknown)}\nAvailable projects: {', '.join(allure_projects)}"
+    elif projects:
+        set_chat_projects(context, chat_id, projects)
+        text = f"You will get notifications of projects: {', '.join(projects)}"
+    else:
+        set_chat_projects(context, chat_id)
+        text = "You will get notifications of all projects"
+    update.message.reply_text(text)
+
+
+def poll_project(project_id: str, context: CallbackContext) -> bool:
+    """
+    Start the notification pipeline of the project on the scheduler tick
+    :param project_id: project id
+    :param context: context
+    :return: return False if the project is leased by another replica
+    """
+    if not leases.owns(project_id):
+        return False
+    _start_pipeline(project_id, context)
+    return True
+
+
+def notify_project(context: CallbackContext) -> None:
+    """
+    Start the notification pipeline of the project passed as the job context
+    :param context: context
+    """
+    _start_pipeline(context.job.context, context)
+
+
+def push_launch(job_queue: JobQueue, project_id: Optional[str], launch_id: int) -> None:
+    """
+    Add a launch received by the webhook to the pending launches and run the pipeline of its project
+    :param job_queue: job queue
+    :param project_id: project id, it may be omitted if only one project is configured
+    :param launch_id: launch id
+    """
+    if project_id is None and len(allure_projects) == 1:
+        project_id = next(iter(allure_projects))
+    if project_id not in allure_projects:
+        raise LookupError(f"Unknown project '{project_id}'")
+    try:
+        launch = allure_projects[project_id].get_launch(launch_id)
+    except HttpResponseErrors as error:
+        if error.status_code == 404:
+            raise LookupError(f"Launch '{launch_id}' not found")
+        raise
+    if str(launch.get('projectId')) != project_id:
+        raise LookupError(f"Launch '{launch_id}' is not in project '{project_id}'")
+
+    if not enqueue_launch(project_id, launch_id, launch.get('name')):
+        logging.info(f"Launch '{launch_id}' has already been processed")
+    elif leases.owns(project_id):
+        job_queue.run_once(notify_project, when=0, context=project_id)
+    else:
+        logging.info(f"Launch '{launch_id}' is left to the replica holding project '{project_id}'")
+
+
+def _start_pipeline(project_id: str, context: CallbackContext) -> None:
+    """
+    Run the notification pipeline of the project in the background.
+    A project still processing the previous run is run again right after it, so it does not delay the others
+    :param project_id: project id
+    :param context: context
+    """
+    with _running_lock:
+        running = _running.get(project_id)
+        if running is not None and not running.done():
+            logging.info(f"Project '{project_id}' is still processing the previous run, it will be run again")
+            _rerun.add(project_id)
+            return
+        future = _pipelines.submit(_notify_project, allure_projects[project_id], context)
+        _running[project_id] = future
+    # a finished future runs the callback at once, it takes the lock itself
+    future.add_done_callback(partial(_pipeline_done, project_id, context))
+
+
+def _pipeline_done(project_id: str, context: CallbackContext, future: Future) -> None:
+    error = future.exception()
+    if error is not None:
+        logging.error(f"Notification of project '{project_id}' failed: {error!r}", exc_info=error)
+    with _running_lock:
+        rerun = project_id in _rerun
+        _rerun.discard(project_id)
+    if rerun and leases.owns(project_id):
+        _start_pipeline(project_id, context)
+    else:
+        scheduler.observe(project_id, None if error is not None else future.result())
+
+
+def _notify_project(allure: AllureAdapter, context: CallbackContext) -> dict:
     """
     Sending a message to a bot
+    :param allure: allure adapter of the project
     :param context: context
+    :return: return the launch activity of the project
     """
-    summary = collect_launch_statistic()
-    if summary != {}:
-        all_subs = []
-        critical_subs = []
-        for key in context.dispatcher.chat_data.keys():
-            subscription = context.dispatcher.chat_data[key].get("subscription")
-            if subscription == 'all':
-                all_subs.append(key)
-            elif subscription == 'critical':
-                critical_subs.append(key)
-
-        report = reporter.generate_report(summary)
-
-        if (report["status"] == "failure") and (len(critical_subs) > 0):
-            _send_report(report_file=report['file_critical'], report_message=report['message_critical'], context=context,
-                         subs=critical_subs, subscription=subscription)
-        else:
-            logging.debug("The number of failed tests does not exceed a critical value")
-
-        if (report["status"] == "failure") and (len(all_subs) > 0):
-            _send_report(report_file=report['file_all'], report_message=report['message_all'], context=context,
-                         subs=all_subs, subscription=subscription)
-        else:
+    project_id = allure.project
+    summary, activity = collect_launch_statistic(allure)
+    if summary:
+        # None stands for the report of all launches, the critical reports are grouped by the percent
+        recipients = subscriptions.critical_groups(int(report_critical), project_id)
+        all_subs = subscriptions.get('all', project_id)
+        if all_subs:
+            recipients[None] = all_subs
+        if not recipients:
+            logging.debug(f"Report of project '{project_id}' has no subscribers")
+            return activity
+
+        report = reporter.generate_report(summary, project_id)
+        if report.status == "success":
             logging.debug("All tests in launch are passed")
+            return activity
+
+        variants = report.group(recipients)
+        reported = {percent for percents in variants.values() for percent in percents}
+        for percent in recipients.keys() - reported:
+            logging.debug(f"The number of failed tests does not exceed a critical value {percent}%")
+
+        # every distinct report is built and sent once for all the chats selecting the same launches
+        report.prepare(variants)
+        render = stage_deadline('render')
+        charts = {mask: report.chart(mask, render) for mask in variants}
+        deadline = stage_deadline('send')
+        for mask, percents in variants.items():
+            subs = [chat_id for percent in percents for chat_id in recipients[percent]]
+            subscription = 'all' if None in percents else f"critical {', '.join(map(str, percents))}%"
+            _send_report(report_chart=charts[mask], report_message=report.message(mask, percents),
+                         context=context, subs=subs, subscription=subscription, deadline=deadline)
 
     else:
-        logging.debug("New launches not found")
+        logging.debug(f"New launches of project '{project_id}' not found")
+    return activity
 
 
-def _send_report(report_file: str, report_message: str, context: CallbackContext, subs: list,
-                 subscription: str) -> None:
+def _send_report(report_chart: Optional[bytes], report_message: str, context: CallbackContext, subs: list,
+                 subscription: str, deadline: Deadline = None) -> None:
     """
     Send report
-    :param report_file: the path to the generated launch picture
+    :param report_chart: the generated launch picture, the report is sent as text without it
     :param report_message: message text
     :param context: context
     :param subs: list of subscribers
     :param subscription: type subscription
+    :param deadline: deadline of the delivery
+    """
+    def deliver(chat_id) -> None:
+        _send_photo(report_chart=report_chart, report_message=report_message, context=context, chat_id=chat_id)
+
+    def on_unauthorized(chat_id) -> None:
+        unsubscribe(context, chat_id)
+
+    # the picture is uploaded to the first chats one by one until Telegram returns its file id
+    subs = list(subs)
+    outcomes = Counter()
+    while subs and report_chart is not None and not get_report_file_id(context, report_chart):
+        outcome = broadcaster.broadcast(subs[:1], deliver, on_unauthorized, deadline)
+        outcomes += outcome
+        subs = subs[1:]
+        if not outcome['unauthorized']:
+            # only a chat which has blocked the bot is skipped, the other failures would repeat for every chat
+            break
+    outcomes += broadcaster.broadcast(subs, deliver, on_unauthorized, deadline)
+    logging.debug(f"Report with '{subscription}' subscription sent: {dict(outcomes)}")
+
+
+def _send_photo(report_chart: Optional[bytes], report_message: str, context: CallbackContext, chat_id) -> None:
+    """
+    Send the report picture by Telegram file id if it has already been uploaded
+    :param report_chart: the generated launch picture, the report is sent as text without it
+    :param report_message: message text
+    :param context: context
+    :param chat_id: chat id
     """
-    for chat_id in subs:
+    if report_chart is None:
+        context.bot.send_message(
+            chat_id=chat_id,
+            text=report_message,
+            parse_mode=parsemode.ParseMode.MARKDOWN_V2
+        )
+        return
+
+    file_id = get_report_file_id(context, report_chart)
+    if file_id:
         try:
             context.bot.send_photo(
                 chat_id=chat_id,
-                photo=open(report_file, 'rb'),
+                photo=file_id,
                 caption=report_message,
                 parse_mode=parsemode.ParseMode.MARKDOWN_V2
             )
-        except Unauthorized as error:
-            logging.info(error.message)
-            unsubscribe(context, chat_id)
+            return
+        except BadRequest as error:
+            # only a rejected file id is dropped, the other errors would fail the upload as well
+            if "file" not in error.message.lower():
+                raise
+            logging.info(f"Cached report picture '{file_id}' rejected: {error.message}")
+            remove_report_file_id(context, report_chart)
 
-        logging.debug(f"Message send to '{chat_id}' with '{subscription}' subscription")
+    message = context.bot.send_photo(
+        chat_id=chat_id,
+        photo=report_chart,
+        caption=report_message,
+        parse_mode=parsemode.ParseMode.MARKDOWN_V2
+    )
+    set_report_file_id(context, report_chart, message.photo[-1].file_id)
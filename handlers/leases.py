@@ -0,0 +1,123 @@
+import os
+import math
+import socket
+import logging
+import threading
+from datetime import datetime
+from time import monotonic
+from typing import Callable
+from handlers.subscriptions import subscriptions
+from persistence.mongo import mongo_persistence
+from tools.projects import form_project_ids
+
+# lease of the replica handling the bot commands and writing the chat data
+COMMANDS_LEASE = "commands"
+
+
+class LeaseManager:
+    """
+    Share projects between bot replicas with leases in MongoDB.
+    Each replica holds a fair share of the projects and renews its leases with a heartbeat,
+    the leases of a dead replica expire and are taken over by the others.
+    One of the replicas also holds the commands lease, the others reload the subscriptions on each heartbeat
+    """
+
+    def __init__(self, replica_id: str, projects: list, ttl: int = 30):
+        self.replica_id = replica_id
+        self._projects = projects
+        self._ttl = ttl
+        self._owned = dict()
+        self._leading = False
+        self._on_elected = None
+        self._on_deposed = None
+        self._lock = threading.Lock()
+
+    @property
+    def leader(self) -> bool:
+        return self._leading
+
+    def owns(self, project_id: str) -> bool:
+        with self._lock:
+            return self._owned.get(project_id, 0) > monotonic()
+
+    def elect(self, on_elected: Callable[[], None], on_deposed: Callable[[], None]) -> None:
+        """
+        Take part in the election of the replica handling the bot commands
+        :param on_elected: function called when the replica takes the commands lease
+        :param on_deposed: function called when the replica loses it
+        """
+        self._on_elected = on_elected
+        self._on_deposed = on_deposed
+
+    def heartbeat(self, _=None) -> None:
+        """
+        Renew the replica heartbeat and the held leases, release the projects over the fair share
+        and acquire free or expired ones up to it
+        """
+        started = monotonic()
+        if self._leading and not self.owns(COMMANDS_LEASE):
+            # the lease has not been renewed in time, another replica may hold it already
+            self._depose()
+        replicas = mongo_persistence.heartbeat_replica(self.replica_id, self._ttl)
+        share = math.ceil(len(self._projects) / max(len(replicas), 1))
+        leases = mongo_persistence.get_leases()
+
+        held = [project for project in self._projects if leases.get(project, {}).get("owner") == self.replica_id]
+        for project in held[share:]:
+            mongo_persistence.release_lease(project, self.replica_id)
+            logging.info(f"Lease of project '{project}' released for the other {len(replicas) - 1} replicas")
+        now = datetime.utcnow()
+        free = [project for project in self._projects
+                if project not in held and (project not in leases or leases[project]["expires_at"] < now)]
+        candidates = held[:share] + free
+
+        owned = list()
+        for project in candidates:
+            if len(owned) >= share:
+                break
+            if mongo_persistence.acquire_lease(project, self.replica_id, self._ttl):
+                if project not in held:
+                    logging.info(f"Lease of project '{project}' acquired by '{self.replica_id}'")
+                owned.append(project)
+
+        leading = self._on_elected is not None and \
+            mongo_persistence.acquire_lease(COMMANDS_LEASE, self.replica_id, self._ttl)
+
+        # the lease is used locally only while it is surely valid in MongoDB
+        deadline = started + self._ttl
+        valid = dict.fromkeys(owned, deadline)
+        if leading:
+            valid[COMMANDS_LEASE] = deadline
+        with self._lock:
+            self._owned = valid
+        logging.debug(f"Replica '{self.replica_id}' of {len(replicas)} holds projects: {owned}")
+
+        if leading and not self._leading:
+            logging.info(f"Replica '{self.replica_id}' handles the bot commands")
+            self._leading = True
+            self._on_elected()
+        elif not leading and self._leading:
+            self._depose()
+        if not self._leading:
+            # the subscriptions are changed by the commands of the leading replica
+            subscriptions.rebuild()
+
+    def _depose(self) -> None:
+        logging.warning(f"Replica '{self.replica_id}' has lost the commands lease")
+        self._leading = False
+        self._on_deposed()
+
+    def release(self) -> None:
+        """Release all held leases, the other replicas take them over on their next heartbeat"""
+        with self._lock:
+            owned, self._owned = self._owned, dict()
+        for project in owned:
+            mongo_persistence.release_lease(project, self.replica_id)
+        logging.info(f"Replica '{self.replica_id}' released leases: {list(owned)}")
+
+
+leases = LeaseManager(
+    replica_id=os.environ.get('BOT_REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}",
+    projects=form_project_ids(),
+    ttl=int(os.environ.get('LEASE_TTL', 30))
+)
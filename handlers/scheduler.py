@@ -0,0 +1,90 @@
+import os
+import logging
+import threading
+from time import monotonic
+from typing import Callable, Optional
+from telegram.ext import CallbackContext, JobQueue
+
+
+class AdaptiveScheduler:
+    """
+    Poll scheduler of the projects.
+    Each project is polled by a chain of one-off jobs, the next poll is scheduled when the previous one has finished,
+    so the polls of a project never overlap. The interval follows the arrival rate of the launches,
+    it drops to the minimum while launches are pending and backs off to the maximum when the project is idle
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, backoff: float = 2, smoothing: float = 0.5):
+        self._min_interval = min_interval
+        self._max_interval = max(max_interval, min_interval)
+        self._backoff = backoff
+        self._smoothing = smoothing
+        self._state = dict()
+        self._jobs = dict()
+        self._job_queue = None
+        self._poll = None
+        self._lock = threading.Lock()
+
+    def start(self, job_queue: JobQueue, poll: Callable[[str, CallbackContext], bool], projects: list,
+              first: float = 10) -> None:
+        """
+        Start polling the projects
+        :param job_queue: job queue
+        :param poll: function starting the poll of a project, returns False if the project is not polled by this bot
+        :param projects: project ids
+        :param first: delay of the first poll in seconds
+        """
+        self._job_queue = job_queue
+        self._poll = poll
+        for project_id in projects:
+            self._schedule(project_id, first)
+
+    def _schedule(self, project_id: str, interval: float) -> None:
+        with self._lock:
+            job = self._jobs.get(project_id)
+            if job is not None:
+                job.schedule_removal()
+            self._jobs[project_id] = self._job_queue.run_once(self._tick, when=interval, context=project_id)
+
+    def _tick(self, context: CallbackContext) -> None:
+        project_id = context.job.context
+        if not self._poll(project_id, context):
+            # the project may be handed over to this bot later, it is checked again soon
+            self._schedule(project_id, self._min_interval)
+
+    def observe(self, project_id: str, activity: Optional[dict]) -> float:
+        """
+        Adjust the interval of the project after a poll and schedule the next one
+        :param project_id: project id
+        :param activity: number of launches arrived since the previous poll and still pending, None if the poll failed
+        :return: return the interval in seconds
+        """
+        now = monotonic()
+        with self._lock:
+            state = self._state.setdefault(project_id, {'interval': self._max_interval, 'rate': 0, 'polled_at': now})
+            if activity is not None:
+                elapsed = max(now - state['polled_at'], self._min_interval)
+                state['rate'] = self._smoothing * activity['arrived'] / elapsed + \
+                    (1 - self._smoothing) * state['rate']
+                state['polled_at'] = now
+
+                # one new launch per poll is expected, the interval grows gradually when the launches stop arriving
+                interval = state['interval'] * self._backoff
+                if state['rate'] > 0:
+                    interval = min(1 / state['rate'], interval)
+                if activity['pending']:
+                    interval = self._min_interval
+                state['interval'] = min(max(interval, self._min_interval), self._max_interval)
+            interval = state['interval']
+
+        logging.debug(f"Next poll of project '{project_id}' in {interval:.0f} seconds")
+        if self._job_queue is not None:
+            self._schedule(project_id, interval)
+        return interval
+
+
+scheduler = AdaptiveScheduler(
+    min_interval=float(os.environ.get('REPORT_INTERVAL_MIN', 60)),
+    max_interval=float(os.environ.get('REPORT_INTERVAL_MAX', os.environ.get('REPORT_INTERVAL', 1200))),
+    backoff=float(os.environ.get('REPORT_INTERVAL_BACKOFF', 2))
+)
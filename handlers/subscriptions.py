@@ -0,0 +1,86 @@
+import logging
+import threading
+from collections import defaultdict
+from persistence.mongo import mongo_persistence
+
+
+class SubscriptionIndex:
+    """
+    Chat ids by subscription type, critical percents and projects of the chats
+    """
+
+    def __init__(self):
+        self._index = defaultdict(set)
+        self._critical_percents = dict()
+        self._projects = dict()
+        self._lock = threading.Lock()
+
+    def rebuild(self) -> None:
+        """Rebuild the index from the persisted chat subscriptions"""
+        index = defaultdict(set)
+        critical_percents = dict()
+        projects = dict()
+        for chat_id, data in mongo_persistence.get_subscriptions().items():
+            index[data["subscription"]].add(chat_id)
+            if data.get("critical_percent") is not None:
+                critical_percents[chat_id] = data["critical_percent"]
+            if data.get("projects"):
+                projects[chat_id] = frozenset(data["projects"])
+        with self._lock:
+            self._index = index
+            self._critical_percents = critical_percents
+            self._projects = projects
+        counts = {key: len(value) for key, value in index.items()}
+        logging.debug(f"Subscriptions loaded: {counts}")
+
+    def add(self, chat_id, subscription: str, critical_percent: int = None) -> None:
+        with self._lock:
+            for chat_ids in self._index.values():
+                chat_ids.discard(chat_id)
+            self._index[subscription].add(chat_id)
+            self._critical_percents.pop(chat_id, None)
+            if critical_percent is not None:
+                self._critical_percents[chat_id] = critical_percent
+
+    def remove(self, chat_id) -> None:
+        with self._lock:
+            for chat_ids in self._index.values():
+                chat_ids.discard(chat_id)
+            self._critical_percents.pop(chat_id, None)
+
+    def set_projects(self, chat_id, projects: list = None) -> None:
+        with self._lock:
+            self._projects.pop(chat_id, None)
+            if projects:
+                self._projects[chat_id] = frozenset(projects)
+
+    def _subscribed(self, chat_id, project_id: str = None) -> bool:
+        projects = self._projects.get(chat_id)
+        return project_id is None or projects is None or project_id in projects
+
+    def get(self, subscription: str, project_id: str = None) -> list:
+        """
+        Get subscribers
+        :param subscription: subscription type
+        :param project_id: project id, chats without chosen projects are subscribed to all of them
+        :return: return chat ids
+        """
+        with self._lock:
+            return [chat_id for chat_id in self._index.get(subscription, ()) if self._subscribed(chat_id, project_id)]
+
+    def critical_groups(self, default_percent: int, project_id: str = None) -> dict:
+        """
+        Group chats with the critical subscription by their critical percent
+        :param default_percent: percent of the chats which have not chosen one
+        :param project_id: project id, chats without chosen projects are subscribed to all of them
+        :return: return chat ids by critical percent
+        """
+        groups = defaultdict(list)
+        with self._lock:
+            for chat_id in self._index.get('critical', ()):
+                if self._subscribed(chat_id, project_id):
+                    groups[self._critical_percents.get(chat_id, default_percent)].append(chat_id)
+        return dict(groups)
+
+
+subscriptions = SubscriptionIndex()
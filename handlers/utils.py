@@ -1,11 +1,15 @@
 import os
+import hashlib
 import logging
+import threading
 
 from telegram import Update
 from telegram.ext import CallbackContext
 from typing import Optional
 
-from adapters.allure import allure
+from adapters.allure import AllureAdapter
+from tools.deadline import Deadline, stage_deadline
+from handlers.subscriptions import subscriptions
 from persistence.mongo import mongo_persistence
 
 
@@ -14,19 +18,36 @@ from persistence.mongo import mongo_persistence
 
 def subscribe_all(context: CallbackContext, chat_id) -> None:
     context.dispatcher.chat_data[chat_id]["subscription"] = 'all'
+    context.dispatcher.chat_data[chat_id].pop("critical_percent", None)
+    subscriptions.add(chat_id, 'all')
     logging.info(f"'{chat_id}' has subscribed in full report")
 
 
-def subscribe_critical(context: CallbackContext, chat_id) -> None:
+def subscribe_critical(context: CallbackContext, chat_id, critical_percent: int = None) -> None:
     context.dispatcher.chat_data[chat_id]["subscription"] = 'critical'
-    logging.info(f"'{chat_id}' has subscribed in critical report")
+    context.dispatcher.chat_data[chat_id]["critical_percent"] = critical_percent
+    subscriptions.add(chat_id, 'critical', critical_percent)
+    logging.info(f"'{chat_id}' has subscribed in critical report, critical percent: {critical_percent}")
 
 
 def unsubscribe(context: CallbackContext, chat_id) -> None:
     context.dispatcher.chat_data[chat_id]["subscription"] = False
+    context.dispatcher.chat_data[chat_id].pop("critical_percent", None)
+    subscriptions.remove(chat_id)
+    # the subscriptions of the other replicas are rebuilt from MongoDB, the write-behind would be too late
+    mongo_persistence.unsubscribe_chat(chat_id)
     logging.info(f"'{chat_id}' has unsubscribed")
 
 
+def set_chat_projects(context: CallbackContext, chat_id, projects: list = None) -> None:
+    if projects:
+        context.dispatcher.chat_data[chat_id]["projects"] = projects
+    else:
+        context.dispatcher.chat_data[chat_id].pop("projects", None)
+    subscriptions.set_projects(chat_id, projects)
+    logging.info(f"'{chat_id}' has chosen projects: {projects or 'all'}")
+
+
 def set_chat_info(update: Update, context: CallbackContext, chat_id) -> None:
     if update.effective_chat.type == 'group':
         context.dispatcher.chat_data[chat_id]["title"] = update.effective_chat.title
@@ -37,51 +58,202 @@ def set_chat_info(update: Update, context: CallbackContext, chat_id) -> None:
         logging.info(f"Private '{chat_id}': username - {update.effective_chat.username}")
 
 
+# Report file ids
+
+
+def _report_hash(report_chart: bytes) -> str:
+    return hashlib.sha1(report_chart).hexdigest()
+
+
+# the cache is replaced, not changed in place, so the persistence copying 'bot_data' never sees it half-updated
+_report_file_ids_lock = threading.Lock()
+
+
+def get_report_file_id(context: CallbackContext, report_chart: bytes) -> Optional[str]:
+    return context.bot_data.get("report_file_ids", {}).get(_report_hash(report_chart))
+
+
+def set_report_file_id(context: CallbackContext, report_chart: bytes, file_id: str) -> None:
+    """
+    Cache the Telegram file id of an uploaded report picture by its content
+    :param context: context
+    :param report_chart: the generated launch picture
+    :param file_id: Telegram file id
+    """
+    cache_size = int(os.environ.get('REPORT_FILE_ID_CACHE', 100))
+    with _report_file_ids_lock:
+        file_ids = dict(context.bot_data.get("report_file_ids", {}))
+        file_ids[_report_hash(report_chart)] = file_id
+        for key in list(file_ids)[:max(len(file_ids) - cache_size, 0)]:
+            file_ids.pop(key, None)
+        context.bot_data["report_file_ids"] = file_ids
+
+
+def remove_report_file_id(context: CallbackContext, report_chart: bytes) -> None:
+    with _report_file_ids_lock:
+        file_ids = dict(context.bot_data.get("report_file_ids", {}))
+        file_ids.pop(_report_hash(report_chart), None)
+        context.bot_data["report_file_ids"] = file_ids
+
+
 # Launches
 
 
-def collect_launch_statistic() -> Optional[dict]:
+def collect_launch_statistic(allure: AllureAdapter) -> tuple:
+    """
+    Collect the statistic of the new finished launches of the project
+    :param allure: allure adapter of the project
+    :return: return the launch summary, None if there are no new finished launches,
+             and the number of launches created since the last run and still pending
+    """
     cleaner = os.environ.get('CLEAR_DB_LAUNCHES')
-    allure.login_with_token()
-    launches = allure.get_last_launches()
+    allure.authorize()
+    cursor = mongo_persistence.get_cursor(allure.project)
+    created_after = None
+    if cursor:
+        created_after = cursor['created_date'] - int(os.environ.get('REPORT_CURSOR_OVERLAP', 5)) * 60 * 1000
+    discover = stage_deadline('discover')
+    allure_launches, id_launches = allure.parse_launches_with_id(allure.iter_last_launches(created_after, discover))
+    discovered_launches = allure_launches.copy()
+    arrived = sum(1 for value in discovered_launches.values()
+                  if not cursor or (value['created_date'] or 0) > cursor['created_date'])
 
-    if (len(launches)) > 0:
-        allure_launches, id_launches = allure.parse_launches_with_id(launches)
-        allure_statuses = allure.wait_launch_status(id_launches)
-        compared_allure_launches = allure.compare_results(allure_launches, allure_statuses)
+    if cleaner == 'True':
+        processed_launches = mongo_persistence.get_processed_launches(allure.project, id_launches)
+        allure_launches = allure.compare_processed_launches(allure_launches, processed_launches)
 
-        launch_results = allure.analyze_results(compared_allure_launches)
-        parsed_launch_results = allure.parse_launch_results(launch_results)
+    compared_allure_launches, unfinished_launches, expired_launches = resolve_launch_statuses(
+        allure, allure_launches, stage_deadline('status')
+    )
+    activity = {'arrived': arrived, 'pending': len(unfinished_launches)}
 
-        launch_statistic = allure.get_launch_statistic(compared_allure_launches)
-        launch_defects = allure.get_launch_defects(compared_allure_launches)
+    if cleaner == 'True':
+        mongo_persistence.update_launch_data(allure.project, dict.fromkeys(expired_launches))
 
-        summary = allure.form_summary(compared_allure_launches, parsed_launch_results, launch_statistic,
-                                      launch_defects)
+    if (len(compared_allure_launches)) > 0:
+        launch_results, launch_statistic, launch_defects, late_launches, failed_launches = \
+            allure.fetch_launch_details(compared_allure_launches, stage_deadline('details'))
+        if late_launches or failed_launches:
+            activity['pending'] += defer_launches(allure, compared_allure_launches, late_launches, failed_launches)
+            compared_allure_launches = {key: value for key, value in compared_allure_launches.items()
+                                        if key not in late_launches and key not in failed_launches}
+        summary = allure.form_summary(compared_allure_launches, launch_results, launch_statistic, launch_defects)
 
         if cleaner == 'True':
-            processed_launches = mongo_persistence.get_launch_data()
-            summary = allure.compare_processed_launches(summary, processed_launches)
-            mongo_persistence.update_launch_data(summary)
+            # another replica may have taken over the project meanwhile, each launch is reported by one of them
+            claimed = set(mongo_persistence.claim_launches(allure.project, list(compared_allure_launches)))
+            summary = {key: value for key, value in summary.items() if key in claimed}
+        # the finished launches are kept pending until now, so a failed run checks them again
+        mongo_persistence.remove_pending_launches(list(compared_allure_launches))
+        if not discover.exceeded:
+            move_cursor(allure, cursor, discovered_launches)
 
-        return summary
+        stats = allure.connection_stats()
+        logging.debug(f"Allure connections after project '{allure.project}': "
+                      f"{stats['opened']} opened, {stats['reused']} reused")
+        return summary, activity
     else:
+        if not discover.exceeded:
+            move_cursor(allure, cursor, discovered_launches)
+        return None, activity
+
+
+def defer_launches(allure: AllureAdapter, allure_launches: dict, late: set, failed: set) -> int:
+    """
+    Keep the finished launches which details have not been fetched in 'pending_launches',
+    they are checked and fetched again on the next run. A failed fetch counts as a check,
+    so a broken launch is skipped after 'REPORT_PENDING_CHECKS' checks
+    :param allure: allure adapter of the project
+    :param allure_launches: finished launches
+    :param late: launches not fetched in time
+    :param failed: launches failed to be fetched
+    :return: return the number of deferred launches
+    """
+    max_checks = int(os.environ.get('REPORT_PENDING_CHECKS', 50))
+    deferred, skipped = dict(), list()
+    for key in late | failed:
+        launch = allure_launches[key]
+        checks = launch['checks'] + (key in failed)
+        if checks >= max_checks:
+            logging.info(f"Launch '{key}' has not been fetched after {max_checks} checks, skipped")
+            skipped.append(key)
+        else:
+            deferred[key] = {'name': launch['name'], 'stage': launch['status'], 'checks': checks}
+
+    mongo_persistence.update_pending_launches(allure.project, deferred)
+    mongo_persistence.remove_pending_launches(skipped)
+    if os.environ.get('CLEAR_DB_LAUNCHES') == 'True':
+        mongo_persistence.update_launch_data(allure.project, dict.fromkeys(skipped))
+    return len(deferred)
+
+
+def enqueue_launch(project_id: str, launch_id: int, name: str) -> bool:
+    """
+    Add a launch to the pending launches of the project, it is reported by the next run of the project
+    :param project_id: project id
+    :param launch_id: launch id
+    :param name: launch name
+    :return: return False if the launch has already been processed
+    """
+    if mongo_persistence.get_processed_launches(project_id, [launch_id]):
+        return False
+    mongo_persistence.update_pending_launches(project_id, {launch_id: {'name': name, 'stage': None, 'checks': 0}})
+    return True
+
+
+def move_cursor(allure: AllureAdapter, cursor: Optional[dict], allure_launches: dict) -> None:
+    """
+    Move the project cursor to the latest discovered launch
+    :param allure: allure adapter of the project
+    :param cursor: current cursor
+    :param allure_launches: launches found in the current run
+    """
+    created = [(value['created_date'], key) for key, value in allure_launches.items() if value['created_date']]
+    if not created:
         return
+    created_date, launch_id = max(created)
+    if not cursor or (created_date, launch_id) > (cursor['created_date'], cursor['launch_id']):
+        mongo_persistence.update_cursor(allure.project, created_date, launch_id)
+
+
+def resolve_launch_statuses(allure: AllureAdapter, allure_launches: dict, deadline: Deadline = None) -> tuple:
+    """
+    Check the stage of new and still pending launches once, without waiting for them.
+    Unfinished launches and the launches not checked in time are kept in 'pending_launches'
+    and checked again on the next run
+    :param allure: allure adapter of the project
+    :param allure_launches: launches found in the current run
+    :param deadline: deadline of the status checks
+    :return: return the launches in 'finished' or 'run_failure' status, the launches still pending
+             and the launches skipped after 'REPORT_PENDING_CHECKS' checks or deleted.
+             The finished launches stay in 'pending_launches' until they are reported
+    """
+    max_checks = int(os.environ.get('REPORT_PENDING_CHECKS', 50))
+    pending = mongo_persistence.get_pending_launches(allure.project)
+    for key, value in allure_launches.items():
+        pending.setdefault(key, {'name': value['name'], 'stage': None, 'checks': 0})
+
+    stages, expired = allure.get_launch_statuses(list(pending), deadline)
+    finished = dict()
+    unfinished = {key: launch for key, launch in pending.items() if key not in stages and key not in expired}
+    for key, stage in stages.items():
+        launch = pending[key]
+        if stage in ["finished", "run_failure"]:
+            finished[key] = {'name': launch['name'], 'status': stage, 'checks': launch['checks']}
+        elif launch['checks'] + 1 >= max_checks:
+            logging.info(f"Launch '{key}' is still in '{stage}' stage after {max_checks} checks, skipped")
+            expired.append(key)
+        else:
+            unfinished[key] = {'name': launch['name'], 'stage': stage, 'checks': launch['checks'] + 1}
 
+    mongo_persistence.update_pending_launches(allure.project, unfinished)
+    mongo_persistence.remove_pending_launches(expired)
+    return finished, unfinished, expired
 
-# Persistence cleanup
 
+# Persistence
 
-def clean_processed_launches(_) -> None:
-    mongo_persistence.drop_table()
-    logging.info("Table 'launch_data' has dropped")
 
+def flush_persistence(_) -> None:
+    mongo_persistence.flush()
 
-def clean_tmp(_) -> None:
-    chart_path = os.environ.get('REPORT_CHART_PATH')
-    path = os.path.join(os.path.abspath(os.path.dirname(__file__)), '../', chart_path)
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if '.png' in file:
-                os.remove(path + file)
-    logging.info(f"Directory '{chart_path}' has cleared")
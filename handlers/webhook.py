@@ -0,0 +1,99 @@
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self) -> None:
+        status, message = self.server.webhook.handle(self.path, self.headers, self.rfile.read)
+        body = json.dumps({"message": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(f"Webhook {self.address_string()}: {format % args}")
+
+
+class LaunchWebhook:
+    """
+    HTTP endpoint receiving launch ids from CI jobs and Allure TestOps webhooks.
+    POST /launches with {"launch_id": 1, "project_id": "1"} passes the launch to the enqueue function,
+    which raises LookupError for an unknown launch or project and ValueError for an invalid one.
+    The requests are accepted only with the secret in the 'X-Webhook-Secret' header
+    """
+
+    path = "/launches"
+    max_body_size = 64 * 1024
+
+    def __init__(self, host: str, port: int, secret: str, enqueue: Callable[[Optional[str], int], None]):
+        if not secret:
+            raise ValueError("Webhook secret is required")
+        self._address = (host, port)
+        self._secret = secret.encode()
+        self._enqueue = enqueue
+        self._server = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def handle(self, path: str, headers, read: Callable[[int], bytes]) -> tuple:
+        """
+        Handle the webhook request, the body is read only after the secret and its length are checked
+        :param path: request path
+        :param headers: request headers
+        :param read: function reading the given number of bytes of the request body
+        :return: return the response status and message
+        """
+        if path.rstrip("/") != self.path:
+            return 404, "Not found"
+        if not hmac.compare_digest(headers.get("X-Webhook-Secret", "").encode(), self._secret):
+            return 401, "Invalid secret"
+        length = headers.get("Content-Length")
+        if length is None:
+            return 411, "Content-Length is required"
+        try:
+            length = int(length)
+        except ValueError:
+            return 400, "Invalid Content-Length"
+        if length < 0:
+            return 400, "Invalid Content-Length"
+        if length > self.max_body_size:
+            return 413, "Request is too large"
+        try:
+            payload = json.loads(read(length) or b"{}")
+            launch_id = payload.get("launch_id", payload.get("launchId"))
+            if launch_id is None:
+                raise ValueError("'launch_id' is required")
+            launch_id = int(launch_id)
+            project_id = payload.get("project_id", payload.get("projectId"))
+            self._enqueue(None if project_id is None else str(project_id), launch_id)
+        except LookupError as error:
+            return 404, str(error)
+        except (ValueError, TypeError, AttributeError) as error:
+            return 400, f"Invalid launch: {error}"
+        except Exception as error:
+            logging.error(f"Launch from webhook has not been enqueued: {error!r}")
+            return 500, "Launch has not been enqueued"
+        logging.info(f"Launch '{launch_id}' received by webhook")
+        return 202, "Accepted"
+
+    def start(self) -> None:
+        self._server = ThreadingHTTPServer(self._address, _WebhookRequestHandler)
+        self._server.daemon_threads = True
+        self._server.webhook = self
+        threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True).start()
+        logging.info(f"Webhook is listening on {self._address[0]}:{self.port}{self.path}")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -1,11 +1,18 @@
+import hashlib
 import logging
 import os
+import threading
+
+from copy import deepcopy
+from datetime import datetime, timedelta
 
 from collections import defaultdict
 from telegram.ext import BasePersistence
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from bson import encode
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 
 
 load_dotenv()
@@ -16,10 +23,22 @@ class MongoPersistence(BasePersistence):
     MongoDB persistence
     """
 
+    _indexes = {
+        "user_data": "user_id",
+        "chat_data": "chat_id",
+        "bot_data": "key",
+        "launch_data": "launch_id",
+        "pending_launches": "launch_id",
+        "cursors": "project_id",
+        "leases": "project_id",
+        "replicas": "replica_id"
+    }
+
     def __init__(self,
                  host,
                  database,
                  port,
+                 launch_retention=1440,
                  store_user_data=True,
                  store_chat_data=True,
                  store_bot_data=True):
@@ -31,33 +50,155 @@ class MongoPersistence(BasePersistence):
 
         self.client = MongoClient(host=host, port=int(port))
         self.db = self.client[database]
+        self.launch_retention = int(launch_retention) * 60
+        self.read_only = False
+        self._write_lock = threading.Lock()
+        self._dirty = dict()
+        self._flushed = dict()
         logging.debug(f"Connected to '{self.db}' on '{host}'")
 
-    def drop_table(self) -> None:
-        self.db["launch_data"].drop()
+    def _create_index(self, collection: str, key: str) -> None:
+        try:
+            self.db[collection].create_index(key, unique=True)
+        except OperationFailure as error:
+            logging.warning(f"Unique index on '{collection}.{key}' has not created: {error}")
+
+    def _create_launch_ttl_index(self) -> None:
+        """
+        Expire processed launches after the retention period
+        """
+        collection = self.db["launch_data"]
+        collection.update_many({"processed_at": {"$exists": False}}, {"$set": {"processed_at": datetime.utcnow()}})
+        index = collection.index_information().get("processed_at_1")
+        if index is None:
+            collection.create_index("processed_at", expireAfterSeconds=self.launch_retention)
+        elif index.get("expireAfterSeconds") != self.launch_retention:
+            self.db.command("collMod", "launch_data",
+                            index={"keyPattern": {"processed_at": 1}, "expireAfterSeconds": self.launch_retention})
+
+    def create_indexes(self) -> None:
+        for collection, key in self._indexes.items():
+            self._create_index(collection, key)
+        self._create_launch_ttl_index()
+        self.db["chat_data"].create_index("data.subscription")
+        self.db["pending_launches"].create_index("project_id")
+        self.db["replicas"].create_index("heartbeat_at", expireAfterSeconds=24 * 60 * 60)
+        logging.debug(f"Indexes created in '{self.db.name}'")
+
+    def adopt_launches(self, project_id: str) -> None:
+        """
+        Assign the launches stored before the projects were tracked separately to the project
+        :param project_id: project id
+        """
+        for collection in ("launch_data", "pending_launches"):
+            result = self.db[collection].update_many({"project_id": {"$exists": False}},
+                                                     {"$set": {"project_id": project_id}})
+            if result.modified_count:
+                logging.info(f"{result.modified_count} documents of '{collection}' assigned to project '{project_id}'")
+
+    def _bulk_upsert(self, collection: str, requests: list) -> None:
+        if requests:
+            self.db[collection].bulk_write(requests, ordered=False)
+
+    @staticmethod
+    def _content_hash(value) -> str:
+        return hashlib.sha1(encode({"value": value})).hexdigest()
+
+    def _mark_flushed(self, collection: str, key_field: str, data: dict) -> None:
+        with self._write_lock:
+            for key, value in data.items():
+                self._flushed[(collection, key_field, key)] = self._content_hash(value)
+
+    def _write_behind(self, collection: str, key_field: str, key, value_field: str, value) -> None:
+        """
+        Queue a snapshot of the document for the next flush if its content has changed since the last flush
+        :param collection: collection name
+        :param key_field: document key field
+        :param key: document key
+        :param value_field: document value field
+        :param value: document value
+        """
+        if self.read_only:
+            return
+        document = (collection, key_field, key)
+        # the live dict keeps changing until the flush, the flushed value must match the hash
+        value = deepcopy(value)
+        content_hash = self._content_hash(value)
+        with self._write_lock:
+            if self._flushed.get(document) == content_hash:
+                self._dirty.pop(document, None)
+            else:
+                self._dirty[document] = (value_field, value, content_hash)
+
+    def flush(self) -> None:
+        """
+        Write all changed documents to MongoDB in one batch per collection
+        """
+        with self._write_lock:
+            dirty, self._dirty = self._dirty, dict()
+        if not dirty or self.read_only:
+            return
+
+        requests = defaultdict(list)
+        for (collection, key_field, key), (value_field, value, _) in dirty.items():
+            requests[collection].append(UpdateOne({key_field: key}, {"$set": {value_field: value}}, upsert=True))
+        try:
+            for collection, collection_requests in requests.items():
+                self._bulk_upsert(collection, collection_requests)
+        except Exception:
+            with self._write_lock:
+                for document, change in dirty.items():
+                    self._dirty.setdefault(document, change)
+            raise
+
+        with self._write_lock:
+            for document, (_, _, content_hash) in dirty.items():
+                self._flushed[document] = content_hash
+        logging.debug(f"{len(dirty)} documents flushed to '{self.db.name}'")
 
     def get_user_data(self) -> dict:
         data = defaultdict(dict)
-        for item in self.db["user_data"].find():
+        for item in self.db["user_data"].find({}, {"_id": 0, "user_id": 1, "data": 1}):
             data[item["user_id"]] = item["data"]
+        self._mark_flushed("user_data", "user_id", data)
         return data
 
     def get_chat_data(self) -> dict:
         data = defaultdict(dict)
-        for item in self.db["chat_data"].find():
+        for item in self.db["chat_data"].find({}, {"_id": 0, "chat_id": 1, "data": 1}):
+            data[item["chat_id"]] = item["data"]
+        self._mark_flushed("chat_data", "chat_id", data)
+        return data
+
+    def get_subscriptions(self) -> dict:
+        data = dict()
+        query = {"data.subscription": {"$in": ["all", "critical"]}}
+        projection = {"_id": 0, "chat_id": 1, "data.subscription": 1, "data.critical_percent": 1, "data.projects": 1}
+        for item in self.db["chat_data"].find(query, projection):
             data[item["chat_id"]] = item["data"]
         return data
 
-    def get_launch_data(self) -> list:
+    def get_processed_launches(self, project_id: str, launch_id: list) -> list:
         data = list()
-        for item in self.db["launch_data"].find():
+        query = {"launch_id": {"$in": launch_id}, "project_id": project_id}
+        for item in self.db["launch_data"].find(query, {"launch_id": 1, "_id": 0}):
             data.append(item['launch_id'])
         return data
 
+    def get_pending_launches(self, project_id: str) -> dict:
+        data = dict()
+        for item in self.db["pending_launches"].find({"project_id": project_id}, {"_id": 0}):
+            data[item["launch_id"]] = {"name": item["name"], "stage": item["stage"], "checks": item["checks"]}
+        return data
+
+    def get_cursor(self, project_id: str) -> dict:
+        return self.db["cursors"].find_one({"project_id": project_id}, {"_id": 0})
+
     def get_bot_data(self) -> dict:
         data = {}
-        for item in self.db["bot_data"].find():
+        for item in self.db["bot_data"].find({}, {"_id": 0, "key": 1, "value": 1}):
             data[item["key"]] = item["value"]
+        self._mark_flushed("bot_data", "key", data)
         return data
 
     def get_callback_data(self) -> dict:
@@ -67,8 +208,9 @@ class MongoPersistence(BasePersistence):
         return data
 
     def get_conversations(self, name: str) -> dict:
+        self._create_index(f"conversation.{name}", "conv")
         data = {}
-        for item in self.db[f"conversation.{name}"].find():
+        for item in self.db[f"conversation.{name}"].find({}, {"_id": 0, "conv": 1, "state": 1}):
             data[tuple(item["conv"])] = item["state"]
         return data
 
@@ -76,23 +218,126 @@ class MongoPersistence(BasePersistence):
         self.db[f"conversation.{name}"].update_one({"conv": key}, {"$set": {"state": new_state}}, upsert=True)
 
     def update_user_data(self, user_id, data):
-        self.db["user_data"].update_one({"user_id": user_id}, {"$set": {"data": data}}, upsert=True)
+        self._write_behind("user_data", "user_id", user_id, "data", data)
 
     def update_chat_data(self, chat_id, data):
-        self.db["chat_data"].update_one({"chat_id": chat_id}, {"$set": {"data": data}}, upsert=True)
+        self._write_behind("chat_data", "chat_id", chat_id, "data", data)
 
     def update_bot_data(self, data):
         for key, value in data.items():
-            self.db["bot_data"].update_one({"key": key}, {"$set": {"value": value}}, upsert=True)
+            self._write_behind("bot_data", "key", key, "value", value)
+
+    def update_launch_data(self, project_id: str, data: dict):
+        if not data:
+            return
+        processed_at = datetime.utcnow()
+        self._bulk_upsert("launch_data", [
+            UpdateOne({"launch_id": key},
+                      {"$set": {"launch_id": key, "project_id": project_id, "processed_at": processed_at}},
+                      upsert=True)
+            for key in data
+        ])
+        logging.debug(f"'launch_id': {list(data)} added to 'launch_data'")
 
-    def update_launch_data(self, data: dict):
+    def update_pending_launches(self, project_id: str, data: dict):
+        self._bulk_upsert("pending_launches", [
+            UpdateOne({"launch_id": key}, {"$set": {**value, "project_id": project_id}}, upsert=True)
+            for key, value in data.items()
+        ])
         for key, value in data.items():
-            self.db["launch_data"].update_one({"launch_id": key}, {"$set": {"launch_id": key}}, upsert=True)
-            logging.debug(f"'launch_id': {key} added to 'launch_data'")
+            logging.debug(f"'launch_id': {key} is pending with '{value['stage']}' stage")
+
+    def update_cursor(self, project_id: str, created_date: int, launch_id: int):
+        self.db["cursors"].update_one(
+            {"project_id": project_id},
+            {"$set": {"created_date": created_date, "launch_id": launch_id}},
+            upsert=True
+        )
+        logging.debug(f"Cursor of project '{project_id}' moved to 'launch_id': {launch_id}")
+
+    def claim_launches(self, project_id: str, launch_id: list) -> list:
+        """
+        Mark launches as processed, a launch is claimed only by the first replica storing it
+        :param project_id: project id
+        :param launch_id: id launch list
+        :return: return the launches claimed by this call
+        """
+        if not launch_id:
+            return []
+        processed_at = datetime.utcnow()
+        requests = [
+            UpdateOne({"launch_id": key},
+                      {"$setOnInsert": {"launch_id": key, "project_id": project_id, "processed_at": processed_at}},
+                      upsert=True)
+            for key in launch_id
+        ]
+        try:
+            upserted = list(self.db["launch_data"].bulk_write(requests, ordered=False).upserted_ids)
+        except BulkWriteError as error:
+            # a concurrent upsert of the same launch by another replica fails on the unique index
+            upserted = [item["index"] for item in error.details.get("upserted", [])]
+        claimed = [launch_id[index] for index in upserted]
+        logging.debug(f"'launch_id': {claimed} claimed in 'launch_data'")
+        return claimed
+
+    def heartbeat_replica(self, replica_id: str, ttl: int) -> list:
+        """
+        Store the replica heartbeat
+        :param replica_id: replica id
+        :param ttl: seconds after the last heartbeat the replica is considered dead
+        :return: return ids of the live replicas
+        """
+        now = datetime.utcnow()
+        self.db["replicas"].update_one({"replica_id": replica_id}, {"$set": {"heartbeat_at": now}}, upsert=True)
+        query = {"heartbeat_at": {"$gte": now - timedelta(seconds=ttl)}}
+        return sorted(item["replica_id"] for item in self.db["replicas"].find(query, {"_id": 0, "replica_id": 1}))
+
+    def get_leases(self) -> dict:
+        data = dict()
+        for item in self.db["leases"].find({}, {"_id": 0}):
+            data[item["project_id"]] = {"owner": item["owner"], "expires_at": item["expires_at"]}
+        return data
+
+    def acquire_lease(self, project_id: str, owner: str, ttl: int) -> bool:
+        """
+        Acquire or renew the project lease if it is free, expired or already held by the owner
+        :param project_id: project id
+        :param owner: replica id
+        :param ttl: lease duration in seconds
+        :return: return True if the lease is held by the owner
+        """
+        now = datetime.utcnow()
+        try:
+            self.db["leases"].update_one(
+                {"project_id": project_id, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def release_lease(self, project_id: str, owner: str) -> None:
+        self.db["leases"].delete_one({"project_id": project_id, "owner": owner})
+
+    def unsubscribe_chat(self, chat_id) -> None:
+        """
+        Unsubscribe the chat in MongoDB at once, also on the replicas which do not write the chat data
+        :param chat_id: chat id
+        """
+        self.db["chat_data"].update_one(
+            {"chat_id": chat_id},
+            {"$set": {"data.subscription": False}, "$unset": {"data.critical_percent": ""}}
+        )
+
+    def remove_pending_launches(self, launch_id: list):
+        if launch_id:
+            self.db["pending_launches"].delete_many({"launch_id": {"$in": launch_id}})
 
 
 mongo_persistence = MongoPersistence(
     host=os.environ.get('MONGO_HOST'),
     port=os.environ.get('MONGO_PORT'),
-    database=os.environ.get('MONGO_DATABASE')
+    database=os.environ.get('MONGO_DATABASE'),
+    launch_retention=os.environ.get('REPORT_LAUNCH_RETENTION', 1440)
 )
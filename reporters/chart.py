@@ -1,8 +1,40 @@
 import os
-import uuid
 import emoji
-import matplotlib.pyplot as plot
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import cached_property
+from itertools import compress
+from typing import Iterable, Optional
+from reporters.renderers import renderer_class
+from reporters.statistic import LaunchStatistic
 from tools.dates import form_nowdate, form_timedelta
+from tools.deadline import Deadline, stage_deadline
+from tools.projects import form_project_ids
+
+
+_renderers = dict()
+
+
+def create_chart(passed, broken, failed, renderer: str = None) -> bytes:
+    """
+    Create chart
+    :param passed: passed test
+    :param broken: broken test
+    :param failed: failed test
+    :param renderer: renderer name
+    :return: return the PNG image
+    """
+    if renderer not in _renderers:
+        _renderers[renderer] = renderer_class(renderer)()
+    return _renderers[renderer].render(passed, broken, failed)
+
+
+def _init_render_worker(renderer: str) -> None:
+    """Create the renderer before the first render in a worker process"""
+    _renderers[renderer] = renderer_class(renderer)()
 
 
 class ChartReporter:
@@ -12,184 +44,239 @@ class ChartReporter:
 
     def __init__(self):
         self._allure_url = os.environ.get('ALLURE_URL')
-        self._allure_project = os.environ.get('ALLURE_PROJECT')
+        self._multi_project = len(form_project_ids()) > 1
         self._report_delta = os.environ.get('REPORT_TIMEDELTA')
-        self._report_critical = os.environ.get('REPORT_CRITICAL_PERCENT')
-        self._report_path = os.environ.get('REPORT_CHART_PATH')
-
-    def _form_status(self, passed, broken, failed) -> dict:
-        return {"passed": passed, "failed": failed, "broken": broken}
-
-    def _form_file_path(self):
-        return f"{self._report_path}{form_nowdate()}{uuid.uuid4()}.png"
+        self._renderer = os.environ.get('REPORT_CHART_RENDERER', 'matplotlib')
+        self._render_workers = int(os.environ.get('REPORT_RENDER_WORKERS', 2))
+        self._render_pool = None
+        self._render_pool_lock = threading.Lock()
 
     def _form_time_interval(self) -> str:
         time_from = form_timedelta(minutes=int(self._report_delta))
         return f"I found unsuccessful launch\(es\) in the period from " \
                f"{time_from} to {form_nowdate()}".replace('-', '\-')
 
-    def _create_chart(self, passed, broken, failed) -> str:
-        """
-        Create chart
-        :param passed: passed test
-        :param broken: broken test
-        :param failed: failed test
-        :return: return the file path
-        """
-        statuses = self._form_status(passed, broken, failed)
-        labels, sizes, colors = list(), list(), list()
-        for key, value in statuses.items():
-            if value > 0:
-                labels.append(key.upper())
-                sizes.append(value)
-                if key == "passed":
-                    colors.append('#96cc64')
-                elif key == "failed":
-                    colors.append('#fd5a3e')
-                elif key == "broken":
-                    colors.append('#ffd050')
-
-        plot.pie(
-            x=sizes,
-            colors=colors,
-            autopct=lambda p: '{:,.0f}'.format(p * sum(sizes) / 100),
-            startangle=120,
-            pctdistance=0.85,
-            textprops=dict(rotation_mode='anchor', va='center', ha='center'),
-            labeldistance=1.2
-        )
-        plot.legend(labels, loc="upper left")
-        centre_circle = plot.Circle((0, 0), 0.70, fc='white')
-        fig = plot.gcf()
-        fig.gca().add_artist(centre_circle)
-
-        plot.axis('equal')
-        plot.tight_layout()
-
-        file_path = self._form_file_path()
-
-        plot.savefig(file_path, dpi=300)
-        plot.close()
-
-        return file_path
-
-    def _create_info_message(self, summary: dict, start_info_message: str, get_defects: bool = False) -> tuple:
+    def _get_render_pool(self) -> ProcessPoolExecutor:
+        with self._render_pool_lock:
+            if self._render_pool is None:
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                context = multiprocessing.get_context(start_method)
+                if start_method == 'forkserver':
+                    context.set_forkserver_preload(renderer_class(self._renderer).modules)
+                self._render_pool = ProcessPoolExecutor(
+                    max_workers=self._render_workers,
+                    mp_context=context,
+                    initializer=_init_render_worker,
+                    initargs=(self._renderer,)
+                )
+            return self._render_pool
+
+    def _reset_render_pool(self) -> None:
+        with self._render_pool_lock:
+            if self._render_pool is not None:
+                self._render_pool.shutdown(wait=False)
+                self._render_pool = None
+
+    def _chart_result(self, future) -> Optional[bytes]:
+        if not future.done():
+            future.cancel()
+            logging.error("Chart has not been rendered in the 'render' stage budget")
+            return None
+        try:
+            return future.result()
+        except BrokenProcessPool as error:
+            logging.error(f"Chart render pool is broken: {error}")
+            self._reset_render_pool()
+        except Exception as error:
+            logging.error(f"Chart has not been rendered: {error}")
+        return None
+
+    def _create_info_message(self, project_id: str, summary: dict, statistic: LaunchStatistic, mask: bytes,
+                             start_info_message: str) -> str:
         """
         Creation of an information message
+        :param project_id: project id
         :param summary: launch data
+        :param statistic: launch statistic of the summary
+        :param mask: mask of the launches of the report
         :param start_info_message: start info message
-        :param get_defects: get information about defect in test
-        :return: return number of tests by statuses and the information message
+        :return: return the information message
         """
-        passed, failed, broken = 0, 0, 0
-
         alarm_emoji = emoji.emojize(':rotating_light:', language='alias')
         warning_emoji = emoji.emojize(':warning:', language='alias')
         mark_emoji = emoji.emojize(':cross_mark:', language='alias')
 
-        info_message = f"{alarm_emoji} {start_info_message} {alarm_emoji}\n"
-
-        launch_with_failed_tests = ""
-        launch_with_broken_tests = ""
-        launch_defects = set()
-
-        for key, value in summary.items():
-            launch_url = f"{mark_emoji} [{value['name'].replace('.', ':').replace('-', '')}]({self._allure_url}/launch/{key})\n"
-            statistic = summary[key]['statistic']
-
-            for status in statistic:
-                if status['status'] == 'passed':
-                    passed = passed + status['count']
-                elif status['status'] == 'broken':
-                    broken = broken + status['count']
-                    launch_with_broken_tests = launch_with_broken_tests + launch_url
-                elif status['status'] == 'failed':
-                    failed = failed + status['count']
-                    launch_with_failed_tests = launch_with_failed_tests + launch_url
-
-            if get_defects:
-                defects = summary[key].get('defects')
-                if defects:
-                    for defect in defects:
-                        defect_name = defect["name"]
-                        defect_id = defect["id"]
-                        defect_url = f"{warning_emoji} [{defect_name}]" \
-                                     f"({self._allure_url}/project/{self._allure_project}/defects/{defect_id})\n"
-                        launch_defects.add(defect_url)
-
-        if failed == 0 and broken == 0:
-            info_message = "All tests passed"
-        else:
-            if launch_with_failed_tests != "":
-                info_message = info_message + "\nLaunches with FAILED status:\n" + launch_with_failed_tests
-            if launch_with_broken_tests != "":
-                info_message = info_message + "\nLaunches with BROKEN status:\n" + launch_with_broken_tests
-            if len(launch_defects) > 0:
-                unpacked_launch_defects = ""
-                for defect in launch_defects:
-                    unpacked_launch_defects += defect
-                info_message = info_message + "\nDefects:\n" + unpacked_launch_defects
-
-        return passed, failed, broken, info_message
-
-    def _count_statistic(self, summary: dict) -> dict:
-        """
-        Count statistic
-        :param summary: launch data
-        :return: filtered resume by status
-        """
-        filtered_summary = dict()
-        for key, value in summary.items():
-            statistic = summary[key]['statistic']
-            if len(statistic) == 0:
-                continue
-            passed, failed, broken = 0, 0, 0
-            for status in statistic:
-                if status['status'] == 'passed':
-                    passed = status['count']
-                elif status['status'] == 'broken':
-                    broken = status['count']
-                elif status['status'] == 'failed':
-                    failed = status['count']
-            if (100 / (passed + broken + failed)) * (broken + failed) > int(self._report_critical):
-                filtered_summary[key] = value
-        return filtered_summary
-
-    def generate_report(self, summary: dict) -> dict:
+        def launch_url(launch_id) -> str:
+            name = summary[launch_id]['name'].replace('.', ':').replace('-', '')
+            return f"{mark_emoji} [{name}]({self._allure_url}/launch/{launch_id})\n"
+
+        launches_with_failed_tests = statistic.launches_with('failed', mask)
+        launches_with_broken_tests = statistic.launches_with('broken', mask)
+        if not launches_with_failed_tests and not launches_with_broken_tests:
+            return "All tests passed"
+
+        launch_defects = dict()
+        for launch_id in compress(statistic.launch_ids, mask):
+            for defect in summary[launch_id].get('defects') or []:
+                launch_defects[f"{warning_emoji} [{defect['name']}]"
+                               f"({self._allure_url}/project/{project_id}/defects/{defect['id']})\n"] = None
+
+        parts = [f"{alarm_emoji} {start_info_message} {alarm_emoji}\n"]
+        if launches_with_failed_tests:
+            parts.append("\nLaunches with FAILED status:\n")
+            parts.extend(map(launch_url, launches_with_failed_tests))
+        if launches_with_broken_tests:
+            parts.append("\nLaunches with BROKEN status:\n")
+            parts.extend(map(launch_url, launches_with_broken_tests))
+        if launch_defects:
+            parts.append("\nDefects:\n")
+            parts.extend(launch_defects)
+        return "".join(parts)
+
+    def generate_report(self, summary: dict, project_id: str) -> 'Report':
         """
         Report generation
         :param summary: launch data
-        :return: return data to create a report of type 'all' and 'critical'
+        :param project_id: project id of the launches
+        :return: return the report, its variants are built on first access
         """
-        message = self._form_time_interval()
-        info_message_all, file_path_all = self._generate_report_data(summary, message)
+        return Report(self, summary, project_id)
 
-        summary_critical = self._count_statistic(summary)
-        message_critical = f"{self._form_time_interval()} with critical {self._report_critical}%"
-        info_message_critical, file_path_critical = self._generate_report_data(summary_critical, message_critical)
+    @staticmethod
+    def _variant_mask(statistic: LaunchStatistic, critical_percent: Optional[int]) -> bytes:
+        """
+        Select launches of the report variant
+        :param statistic: launch statistic
+        :param critical_percent: critical percent, None for the report of all launches
+        :return: return the mask of the launches
+        """
+        if critical_percent is None:
+            return statistic.all_mask()
+        return statistic.critical_mask(critical_percent)
 
-        if "All tests passed" in info_message_all:
-            status = 'success'
-        else:
-            status = 'failure'
+    def _variant_title(self, project_id: str, critical_percents: tuple) -> str:
+        title = self._form_time_interval()
+        if self._multi_project:
+            title = f"{title} in project {project_id}"
+        if None in critical_percents:
+            return title
+        percents = ", ".join(f"{percent}%" for percent in critical_percents)
+        return f"{title} with critical {percents}"
 
-        return {'file_critical': file_path_critical, 'message_critical': info_message_critical,
-                'file_all': file_path_all, 'message_all': info_message_all, 'status': status}
+    def _submit_chart(self, statistic: tuple) -> Optional[Future]:
+        try:
+            return self._get_render_pool().submit(create_chart, *statistic, renderer=self._renderer)
+        except BrokenProcessPool as error:
+            logging.error(f"Chart render pool is broken: {error}")
+            self._reset_render_pool()
+            return None
 
-    def _generate_report_data(self, summary: dict, message: str) -> tuple:
+
+class Report:
+    """
+    Report of one notification cycle.
+    Variants selecting the same launches share one message and chart, both are built on first access
+    """
+
+    def __init__(self, reporter: ChartReporter, summary: dict, project_id: str):
+        self._reporter = reporter
+        self._summary = summary
+        self.project_id = project_id
+        self._masks = dict()
+        self._messages = dict()
+        self._charts = dict()
+        self._renders = dict()
+        self._lock = threading.RLock()
+
+    @cached_property
+    def statistic(self) -> LaunchStatistic:
+        return LaunchStatistic(self._summary)
+
+    def mask(self, critical_percent: Optional[int] = None) -> bytes:
         """
-        Report data generation
-        :param summary: launch data
-        :param message: message text
-        :return: return the information message and file path
-        """
-        passed, failed, broken, info_message = self._create_info_message(
-            summary=summary,
-            start_info_message=message,
-            get_defects=True
-        )
-        file_path = self._create_chart(passed, broken, failed)
-        return info_message, file_path
+        Launches of the report variant
+        :param critical_percent: critical percent, None for the report of all launches
+        :return: return the mask of the launches
+        """
+        with self._lock:
+            if critical_percent not in self._masks:
+                self._masks[critical_percent] = self._reporter._variant_mask(self.statistic, critical_percent)
+            return self._masks[critical_percent]
+
+    @cached_property
+    def status(self) -> str:
+        """Status of the whole report, 'failure' if any launch has failed or broken tests"""
+        return self.variant_status(self.mask())
+
+    def variant_status(self, mask: bytes) -> str:
+        """
+        Report variant status
+        :param mask: launches of the variant
+        :return: return 'failure' if the variant has failed or broken tests, otherwise 'success'
+        """
+        passed, broken, failed = self.statistic.totals(mask)
+        return 'failure' if failed or broken else 'success'
+
+    def group(self, critical_percents: Iterable) -> dict:
+        """
+        Group the report variants by the launches they select, variants without failures are skipped
+        :param critical_percents: critical percents, None for the report of all launches
+        :return: return the critical percents by mask of the launches
+        """
+        variants = dict()
+        for critical_percent in sorted(set(critical_percents), key=lambda percent: -1 if percent is None else percent):
+            mask = self.mask(critical_percent)
+            if self.variant_status(mask) == 'failure':
+                variants.setdefault(mask, []).append(critical_percent)
+        return {mask: tuple(percents) for mask, percents in variants.items()}
+
+    def message(self, mask: bytes, critical_percents: tuple) -> str:
+        """
+        Report variant message
+        :param mask: launches of the variant
+        :param critical_percents: critical percents of the variant, listed in the message title
+        :return: return the information message
+        """
+        key = (mask, critical_percents)
+        with self._lock:
+            if key not in self._messages:
+                self._messages[key] = self._reporter._create_info_message(
+                    self.project_id, self._summary, self.statistic, mask,
+                    self._reporter._variant_title(self.project_id, critical_percents)
+                )
+            return self._messages[key]
+
+    def prepare(self, masks: Iterable) -> None:
+        """
+        Start rendering the charts of the variants in parallel
+        :param masks: launches of the variants
+        """
+        with self._lock:
+            for mask in masks:
+                totals = self.statistic.totals(mask)
+                if totals in self._charts or totals in self._renders:
+                    continue
+                self._renders[totals] = self._reporter._submit_chart(totals)
+
+    def chart(self, mask: bytes, deadline: Deadline = None) -> Optional[bytes]:
+        """
+        Report variant chart, variants with the same totals share one chart
+        :param mask: launches of the variant
+        :param deadline: render deadline shared by the variants, 'REPORT_RENDER_BUDGET' of this chart by default
+        :return: return the PNG image, None if the chart has not been rendered
+        """
+        totals = self.statistic.totals(mask)
+        with self._lock:
+            if totals in self._charts:
+                return self._charts[totals]
+            self.prepare([mask])
+            future = self._renders.pop(totals)
+            if future is not None:
+                (deadline or stage_deadline('render')).wait([future])
+                self._charts[totals] = self._reporter._chart_result(future)
+            else:
+                self._charts[totals] = None
+            return self._charts[totals]
 
 
 reporter = ChartReporter()
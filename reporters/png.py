@@ -0,0 +1,204 @@
+import math
+import struct
+import zlib
+from reporters.renderers import ChartRenderer
+
+# 5x7 bitmap glyphs of the characters used on the chart
+FONT = {
+    '0': ["01110", "10001", "10011", "10101", "11001", "10001", "01110"],
+    '1': ["00100", "01100", "00100", "00100", "00100", "00100", "01110"],
+    '2': ["01110", "10001", "00001", "00010", "00100", "01000", "11111"],
+    '3': ["11111", "00010", "00100", "00010", "00001", "10001", "01110"],
+    '4': ["00010", "00110", "01010", "10010", "11111", "00010", "00010"],
+    '5': ["11111", "10000", "11110", "00001", "00001", "10001", "01110"],
+    '6': ["00110", "01000", "10000", "11110", "10001", "10001", "01110"],
+    '7': ["11111", "00001", "00010", "00100", "01000", "01000", "01000"],
+    '8': ["01110", "10001", "10001", "01110", "10001", "10001", "01110"],
+    '9': ["01110", "10001", "10001", "01111", "00001", "00010", "01100"],
+    ',': ["00000", "00000", "00000", "00000", "00110", "00100", "01000"],
+    'A': ["01110", "10001", "10001", "11111", "10001", "10001", "10001"],
+    'B': ["11110", "10001", "10001", "11110", "10001", "10001", "11110"],
+    'D': ["11100", "10010", "10001", "10001", "10001", "10010", "11100"],
+    'E': ["11111", "10000", "10000", "11110", "10000", "10000", "11111"],
+    'F': ["11111", "10000", "10000", "11110", "10000", "10000", "10000"],
+    'I': ["01110", "00100", "00100", "00100", "00100", "00100", "01110"],
+    'K': ["10001", "10010", "10100", "11000", "10100", "10010", "10001"],
+    'L': ["10000", "10000", "10000", "10000", "10000", "10000", "11111"],
+    'N': ["10001", "11001", "10101", "10011", "10001", "10001", "10001"],
+    'O': ["01110", "10001", "10001", "10001", "10001", "10001", "01110"],
+    'P': ["11110", "10001", "10001", "11110", "10000", "10000", "10000"],
+    'R': ["11110", "10001", "10001", "11110", "10100", "10010", "10001"],
+    'S': ["01111", "10000", "10000", "01110", "00001", "00001", "11110"],
+}
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+BORDER = (204, 204, 204)
+
+
+def _rgb(color: str) -> tuple:
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def _blend(color: tuple, background: tuple, alpha: float) -> bytes:
+    return bytes(round(c * alpha + b * (1 - alpha)) for c, b in zip(color, background))
+
+
+def encode_png(width: int, height: int, rows: list) -> bytes:
+    """
+    Encode PNG image
+    :param width: image width
+    :param height: image height
+    :param rows: RGB rows of the image
+    :return: return the PNG image
+    """
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + \
+            struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    raw = b"".join(b"\x00" + bytes(row) for row in rows)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + \
+        chunk(b"IEND", b"")
+
+
+class NativeRenderer(ChartRenderer):
+    """
+    Donut chart renderer without third-party dependencies
+    """
+
+    name = 'native'
+    modules = ['reporters.png']
+
+    def __init__(self, width: int = 960, height: int = 720):
+        self._width = width
+        self._height = height
+
+    def _fill(self, rows: list, x: int, y: int, width: int, height: int, color: tuple) -> None:
+        pixels = bytes(color) * width
+        for row in rows[max(y, 0):min(y + height, self._height)]:
+            row[x * 3:(x + width) * 3] = pixels
+
+    def _text(self, rows: list, x: int, y: int, text: str, scale: int, color: tuple = BLACK) -> None:
+        for index, char in enumerate(text):
+            glyph = FONT.get(char)
+            if glyph is None:
+                continue
+            left = x + index * 6 * scale
+            for line, bits in enumerate(glyph):
+                for column, bit in enumerate(bits):
+                    if bit == "1":
+                        self._fill(rows, left + column * scale, y + line * scale, scale, scale, color)
+
+    @staticmethod
+    def _text_size(text: str, scale: int) -> tuple:
+        return len(text) * 6 * scale - scale, 7 * scale
+
+    @staticmethod
+    def _segment(angle: float, bounds: list) -> int:
+        segment = 0
+        while segment < len(bounds) - 1 and angle >= bounds[segment]:
+            segment += 1
+        return segment
+
+    @staticmethod
+    def _half_width(radius: float, dy: float) -> float:
+        return math.sqrt(radius * radius - dy * dy) if abs(dy) < radius else -1
+
+    def _draw_donut(self, rows: list, sizes: list, colors: list) -> None:
+        cx, cy = self._width / 2, self._height / 2
+        outer = min(self._width, self._height) * 0.43
+        inner = outer * 0.70
+        total = sum(sizes)
+        bounds, cumulative = list(), 0
+        for size in sizes:
+            cumulative += size
+            bounds.append(cumulative / total * 360)
+        rays = [math.radians(bound + 120) for bound in [0] + bounds[:-1]]
+        colors = [_rgb(color) for color in colors]
+        fills = [bytes(color) for color in colors]
+
+        def angle_of(x: int, dy: float) -> float:
+            return (math.degrees(math.atan2(-dy, x + 0.5 - cx)) - 120) % 360
+
+        def blend_pixel(row: bytearray, x: int, dy: float) -> None:
+            dx = x + 0.5 - cx
+            distance = math.sqrt(dx * dx + dy * dy)
+            alpha = min(outer + 0.5 - distance, distance - inner + 0.5, 1)
+            if alpha > 0:
+                row[x * 3:x * 3 + 3] = _blend(colors[self._segment(angle_of(x, dy), bounds)], WHITE, alpha)
+
+        def fill_run(row: bytearray, start: int, stop: int, dy: float) -> None:
+            splits = {start, stop}
+            for ray in rays:
+                sin = math.sin(ray)
+                if abs(sin) < 1e-9 or -dy / sin <= 0:
+                    continue
+                split = math.ceil(cx + -dy / sin * math.cos(ray) - 0.5)
+                if start < split < stop:
+                    splits.add(split)
+            splits = sorted(splits)
+            for left, right in zip(splits, splits[1:]):
+                segment = self._segment(angle_of((left + right - 1) // 2, dy), bounds)
+                row[left * 3:right * 3] = fills[segment] * (right - left)
+
+        for y in range(max(int(cy - outer) - 1, 0), min(int(cy + outer) + 2, self._height)):
+            dy = y + 0.5 - cy
+            row = rows[y]
+            edge = self._half_width(outer + 1, dy)
+            if edge < 0:
+                continue
+            solid_outer = self._half_width(outer - 0.5, dy)
+            solid_inner = self._half_width(inner + 0.5, dy)
+            hole = self._half_width(inner - 0.5, dy)
+            parts = list()
+            if solid_outer >= 0 and solid_inner < 0:
+                parts.append((True, -solid_outer, solid_outer))
+            elif solid_outer >= 0:
+                parts.append((True, -solid_outer, -solid_inner))
+                if hole >= 0:
+                    parts.append((False, -hole, hole))
+                parts.append((True, solid_inner, solid_outer))
+
+            # solid runs are filled at once, the hole is skipped, only the edges are blended per pixel
+            x = max(int(cx - edge), 0)
+            for solid, low, high in parts:
+                start = max(math.ceil(cx + low - 0.5), x)
+                stop = math.floor(cx + high - 0.5) + 1
+                for pixel in range(x, start):
+                    blend_pixel(row, pixel, dy)
+                if solid and stop > start:
+                    fill_run(row, start, stop, dy)
+                x = max(stop, x)
+            for pixel in range(x, min(int(cx + edge) + 1, self._width)):
+                blend_pixel(row, pixel, dy)
+
+        start = 0
+        for size, bound in zip(sizes, bounds):
+            middle = math.radians((start + bound) / 2 + 120)
+            label = '{:,.0f}'.format(size)
+            text_width, text_height = self._text_size(label, 3)
+            x = cx + math.cos(middle) * outer * 0.85
+            y = cy - math.sin(middle) * outer * 0.85
+            self._text(rows, int(x - text_width / 2), int(y - text_height / 2), label, 3)
+            start = bound
+
+    def _draw_legend(self, rows: list, labels: list, colors: list) -> None:
+        scale, padding = 3, 12
+        line_height = 7 * scale + padding
+        width = max(self._text_size(label, scale)[0] for label in labels) + 3 * padding + 40
+        height = len(labels) * line_height + padding
+        left, top = 20, 20
+        self._fill(rows, left, top, width, height, BORDER)
+        self._fill(rows, left + 2, top + 2, width - 4, height - 4, WHITE)
+        for index, (label, color) in enumerate(zip(labels, colors)):
+            y = top + padding + index * line_height
+            self._fill(rows, left + padding, y, 40, 7 * scale, _rgb(color))
+            self._text(rows, left + 2 * padding + 40, y, label, scale)
+
+    def render(self, passed, broken, failed) -> bytes:
+        labels, sizes, colors = self._form_statuses(passed, broken, failed)
+        rows = [bytearray(bytes(WHITE) * self._width) for _ in range(self._height)]
+        self._draw_donut(rows, sizes, colors)
+        self._draw_legend(rows, labels, colors)
+        return encode_png(self._width, self._height, rows)
@@ -0,0 +1,99 @@
+import os
+from abc import ABC, abstractmethod
+from io import BytesIO
+
+STATUS_COLORS = {"passed": '#96cc64', "failed": '#fd5a3e', "broken": '#ffd050'}
+
+
+class ChartRenderer(ABC):
+    """
+    Donut chart renderer
+    """
+
+    name = None
+    modules = []
+
+    @staticmethod
+    def _form_statuses(passed, broken, failed) -> tuple:
+        """
+        Form chart statuses
+        :param passed: passed test
+        :param broken: broken test
+        :param failed: failed test
+        :return: return the labels, sizes and colors of the non-empty statuses
+        """
+        statuses = {"passed": passed, "failed": failed, "broken": broken}
+        labels, sizes, colors = list(), list(), list()
+        for key, value in statuses.items():
+            if value > 0:
+                labels.append(key.upper())
+                sizes.append(value)
+                colors.append(STATUS_COLORS[key])
+        if not sizes:
+            raise ValueError("All wedge sizes are zero")
+        return labels, sizes, colors
+
+    @abstractmethod
+    def render(self, passed, broken, failed) -> bytes:
+        """
+        Render chart
+        :param passed: passed test
+        :param broken: broken test
+        :param failed: failed test
+        :return: return the PNG image
+        """
+
+
+class MatplotlibRenderer(ChartRenderer):
+    """
+    Donut chart renderer based on matplotlib
+    """
+
+    name = 'matplotlib'
+    modules = ['matplotlib.figure', 'matplotlib.patches', 'matplotlib.backends.backend_agg']
+
+    def __init__(self, dpi: int = 300):
+        from matplotlib.figure import Figure
+        from matplotlib.patches import Circle
+        self._figure = Figure
+        self._circle = Circle
+        self._dpi = dpi
+
+    def render(self, passed, broken, failed) -> bytes:
+        labels, sizes, colors = self._form_statuses(passed, broken, failed)
+
+        figure = self._figure()
+        axes = figure.subplots()
+        axes.pie(
+            x=sizes,
+            colors=colors,
+            autopct=lambda p: '{:,.0f}'.format(p * sum(sizes) / 100),
+            startangle=120,
+            pctdistance=0.85,
+            textprops=dict(rotation_mode='anchor', va='center', ha='center'),
+            labeldistance=1.2
+        )
+        axes.legend(labels, loc="upper left")
+        axes.add_artist(self._circle((0, 0), 0.70, fc='white'))
+
+        axes.axis('equal')
+        figure.tight_layout()
+
+        chart = BytesIO()
+        figure.savefig(chart, format='png', dpi=self._dpi)
+        return chart.getvalue()
+
+
+def renderer_class(name: str = None) -> type:
+    """
+    Get chart renderer class
+    :param name: renderer name, 'REPORT_CHART_RENDERER' by default
+    :return: return the renderer class
+    """
+    name = name or os.environ.get('REPORT_CHART_RENDERER', 'matplotlib')
+    if name == 'native':
+        from reporters.png import NativeRenderer
+        return NativeRenderer
+    if name == 'matplotlib':
+        return MatplotlibRenderer
+    raise ValueError(f"Unknown chart renderer '{name}'")
@@ -0,0 +1,61 @@
+from array import array
+from itertools import compress
+
+
+class LaunchStatistic:
+    """
+    Table of the number of tests by status for each launch of the summary.
+    Built in one pass, the report variants are selected from it by masks
+    """
+
+    statuses = ("passed", "broken", "failed")
+
+    def __init__(self, summary: dict):
+        self.launch_ids = list()
+        self.counts = {status: array('q') for status in self.statuses}
+        for launch_id, value in summary.items():
+            counts = dict.fromkeys(self.statuses, 0)
+            for status in value['statistic']:
+                if status['status'] in counts:
+                    counts[status['status']] += status['count']
+            self.launch_ids.append(launch_id)
+            for status in self.statuses:
+                self.counts[status].append(counts[status])
+
+    def __len__(self) -> int:
+        return len(self.launch_ids)
+
+    def all_mask(self) -> bytes:
+        return b"\x01" * len(self)
+
+    def critical_mask(self, percent: float) -> bytes:
+        """
+        Select launches with a share of failed and broken tests over the percent
+        :param percent: critical percent
+        :return: return the mask of the selected launches
+        """
+        return bytes(
+            total > 0 and (broken + failed) * 100 > percent * total
+            for total, broken, failed in zip(self.totals_by_launch(), self.counts["broken"], self.counts["failed"])
+        )
+
+    def totals_by_launch(self):
+        return map(sum, zip(*self.counts.values()))
+
+    def totals(self, mask: bytes) -> tuple:
+        """
+        Sum statistic of the selected launches
+        :param mask: mask of the launches
+        :return: return the number of passed, broken and failed tests
+        """
+        return tuple(sum(compress(self.counts[status], mask)) for status in self.statuses)
+
+    def launches_with(self, status: str, mask: bytes) -> list:
+        """
+        Selected launches with tests in the status
+        :param status: test status
+        :param mask: mask of the launches
+        :return: return the launch ids
+        """
+        return [launch_id for launch_id, count in zip(compress(self.launch_ids, mask),
+                                                      compress(self.counts[status], mask)) if count > 0]
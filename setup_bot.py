@@ -38,16 +38,14 @@ def generate_env_file(allure_project, allure_url, allure_user_token, bot_token,
 
     def report_parameters():
         return '# Report settings\n' \
-               f'REPORT_INTERVAL="20"\n' \
+               f'REPORT_INTERVAL="1200"\n' \
                f'REPORT_TIMEDELTA="200"\n' \
-               f'REPORT_CHART_PATH="./tmp/"\n' \
                f'REPORT_CRITICAL_PERCENT="50"\n\n'
 
     def rest_parameters():
         return '# Rest settings\n' \
                f'TIMEZONE="UTC"\n' \
-               f'CLEAR_DB_LAUNCHES="True"\n' \
-               f'CLEAR_DATE_TMP="59 23 */5 * *"\n'
+               f'CLEAR_DB_LAUNCHES="True"\n'
 
     allure = allure_parameters(allure_project, allure_url, allure_user_token)
     bot = bot_parameters(bot_token)
@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import TimeoutError, wait
+from time import monotonic
+from typing import Iterable, Optional
+from exceptions import DeadlineExceeded
+
+# default time budgets of the notification stages, seconds
+STAGE_BUDGETS = {
+    'discover': 60,
+    'status': 60,
+    'details': 120,
+    'render': 30,
+    'send': 120
+}
+
+
+class Deadline:
+    """
+    Time budget of a notification stage.
+    The work cut by the deadline is marked as exceeded, so the stage can defer it to the next run
+    """
+
+    def __init__(self, seconds: Optional[float], stage: str = None):
+        self.stage = stage
+        self.exceeded = False
+        self._expires_at = None if seconds is None else monotonic() + seconds
+
+    def remaining(self) -> Optional[float]:
+        """
+        Remaining time
+        :return: return the remaining seconds, None for the unlimited budget
+        """
+        if self._expires_at is None:
+            return None
+        return max(self._expires_at - monotonic(), 0)
+
+    def expired(self) -> bool:
+        if self._expires_at is not None and monotonic() >= self._expires_at:
+            self.exceeded = True
+        return self.exceeded
+
+    def wait(self, futures: Iterable) -> tuple:
+        """
+        Wait for the futures within the budget, the futures which have not started yet are cancelled after it
+        :param futures: futures
+        :return: return the done and not done futures
+        """
+        done, not_done = wait(list(futures), timeout=self.remaining())
+        if not_done:
+            self.exceeded = True
+            for future in not_done:
+                future.cancel()
+        return done, not_done
+
+    def result(self, future):
+        """
+        Wait for the future result within the budget
+        :param future: future
+        :return: return the future result, raises DeadlineExceeded after the budget
+        """
+        try:
+            return future.result(timeout=self.remaining())
+        except TimeoutError:
+            self.exceeded = True
+            future.cancel()
+            raise DeadlineExceeded(self.stage)
+
+
+def stage_deadline(stage: str) -> Deadline:
+    """
+    Start the stage deadline
+    :param stage: stage name, the budget is read from 'REPORT_<STAGE>_BUDGET'
+    :return: return the deadline
+    """
+    return Deadline(float(os.environ.get(f'REPORT_{stage.upper()}_BUDGET', STAGE_BUDGETS[stage])), stage)
@@ -1,5 +1,6 @@
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 from exceptions import HttpResponseErrors
 
@@ -9,9 +10,18 @@ class HTTPClient:
     Http-клиент
     """
 
-    def __init__(self, base_url):
+    def __init__(self, base_url, pool_size: int = 10, keep_alive: bool = True, connect_timeout: float = 5,
+                 read_timeout: float = 30, gzip: bool = True):
         self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
         self.session = requests.session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        self.session.headers.update({
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            'Accept-Encoding': 'gzip, deflate' if gzip else 'identity'
+        })
 
     @staticmethod
     def __request_log(func, response):
@@ -25,6 +35,7 @@ class HTTPClient:
         return format_url
 
     def __perform_request(self, method: str, endpoint: str, retries: int = 3, expected_code: int = None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
         for _ in range(retries):
             response = self.session.request(
                 method=method,
@@ -34,7 +45,9 @@ class HTTPClient:
             self.__request_log(method, response)
 
             retry_status_code_list = range(400, 505)
-            if response.status_code != expected_code and response.status_code not in retry_status_code_list:
+            if response.status_code == 401 and expected_code != 401:
+                raise HttpResponseErrors(expected_code, response.status_code)
+            elif response.status_code != expected_code and response.status_code not in retry_status_code_list:
                 raise HttpResponseErrors(expected_code, response.status_code)
             elif response.status_code in retry_status_code_list:
                 if _ == retries - 1:
@@ -42,6 +55,24 @@ class HTTPClient:
                 continue
             return response
 
+    def connection_stats(self) -> dict:
+        """
+        Connection pool statistic
+        :return: return the number of opened and reused connections
+        """
+        opened, requests_count = 0, 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_count += pool.num_requests
+        return {'opened': opened, 'reused': max(requests_count - opened, 0)}
+
+    def close(self) -> None:
+        self.session.close()
+
     def get(self, endpoint, expected_code=200, **kwargs):
         return self.__perform_request(method="get", endpoint=endpoint, expected_code=expected_code, **kwargs)
 
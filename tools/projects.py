@@ -0,0 +1,11 @@
+import os
+
+
+def form_project_ids(projects: str = None) -> list:
+    """
+    Form project ids
+    :param projects: comma separated project ids, 'ALLURE_PROJECT' by default
+    :return: return the list of project ids
+    """
+    projects = os.environ.get('ALLURE_PROJECT', '') if projects is None else projects
+    return [project.strip() for project in projects.split(',') if project.strip()]